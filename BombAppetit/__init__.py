@@ -3,3 +3,9 @@
 # __all__ = ['encrypt_json', 'decrypt_json']
 
 from .functions import *
+from .instrument import *
+from .batch import *
+from .keypool import *
+from .verifycache import *
+from .replay import *
+from .sessionstore import *
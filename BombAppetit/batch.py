@@ -0,0 +1,257 @@
+
+from concurrent.futures import ProcessPoolExecutor
+
+from .functions import Envelope, encrypt_json, decrypt_json, check_json, test_json_hash, test_merkle_items, str_to_key, \
+                       MAX_DOCUMENT_SIZE, _as_envelope, _check_document, _count_rejection
+
+
+# -- batch API --
+#
+# RSA under pycryptodome holds the GIL, so many documents are only processed
+# in parallel across processes. The *_many() functions split their input in
+# chunks of chunk_size and run them on a ProcessPoolExecutor, either the one
+# given in executor or a temporary one with max_workers processes. Batches
+# that fit in a single chunk run inline, a pool would only add overhead.
+#
+# Results keep the input order and errors are reported per item, each result
+# is a pair like the one decrypt_json() returns:
+#     encrypt_many() -> (encrypted_document, None) or (None, error)
+#     decrypt_many() -> (json_object, nonce)       or (None, error)
+#     verify_many()  -> (True, None)               or (False, error)
+#     check_many()   -> (True, nonce)              or (None, error)
+#
+# Key objects cannot be pickled, keys cross the process boundary as PEM and
+# are parsed again (once, through the key cache) in each worker.
+#
+# With verify_cache, a VerifyCache, signatures already known good are not sent
+# for verification, and the ones verified by the workers are added to the
+# cache in the calling process.
+#
+
+BATCH_CHUNK_SIZE = 16
+
+def _export_key(key):
+    ''' Returns key as PEM, so it can be sent to a worker process.'''
+    if key is None:
+        return None
+    return key.export_key(format='PEM')
+
+def _import_key(key_pem):
+    ''' Reverses _export_key() in the worker process.'''
+    if key_pem is None:
+        return None
+    return str_to_key(key_pem)
+
+def _per_item(value, count):
+    ''' Expands a single value, or checks a list has one value per item.'''
+    if isinstance(value, (list, tuple)):
+        if len(value) != count:
+            raise ValueError(f"Expected {count} keys, got {len(value)}")
+        return list(value)
+    return [value] * count
+
+def _as_document(encrypted_document):
+    ''' Envelopes cache hash objects that cannot be pickled, send the dict.'''
+    if isinstance(encrypted_document, Envelope):
+        return encrypted_document.document
+    return encrypted_document
+
+def _encrypt_chunk(items):
+    results = []
+    for json_object, src_pem, dst_pem, sections_to_encrypt, mode, compress in items:
+        try:
+            document = encrypt_json(json_object, _import_key(src_pem), _import_key(dst_pem),
+                                    sections_to_encrypt, mode=mode, compress=compress)
+            results.append((document, None))
+        except Exception as e:
+            results.append((None, f"{type(e).__name__}: {e}"))
+    return results
+
+def _decrypt_chunk(items):
+    results = []
+    for encrypted_document, src_pem, dst_pem, seen_nonces, freshness_check, only_sections in items:
+        try:
+            results.append(decrypt_json(encrypted_document, _import_key(src_pem), _import_key(dst_pem),
+                                        seen_nonces=seen_nonces, freshness_check=freshness_check,
+                                        only_sections=only_sections))
+        except Exception as e:
+            results.append((None, f"{type(e).__name__}: {e}"))
+    return results
+
+def _verify_chunk(items):
+    results = []
+    for encrypted_document, src_pem in items:
+        try:
+            test_json_hash(encrypted_document, _import_key(src_pem))
+            results.append((True, None))
+        except Exception as e:
+            results.append((False, f"{type(e).__name__}: {e}"))
+    return results
+
+def _check_chunk(items):
+    results = []
+    for encrypted_document, src_pem, freshness_check, is_verified in items:
+        try:
+            if is_verified:
+                # signature found in the verify cache, the rest is checked
+                envelope, error = _check_document(encrypted_document, None, None, freshness_check, None,
+                                                  MAX_DOCUMENT_SIZE, None)
+                results.append((True, envelope.nonce) if envelope is not None else (None, error))
+                continue
+            results.append(check_json(encrypted_document, _import_key(src_pem), freshness_check=freshness_check))
+        except Exception as e:
+            results.append((None, f"{type(e).__name__}: {e}"))
+    return results
+
+def _cache_entries(verify_cache, documents, src_keys):
+    ''' Returns the cache entry of every document, and which are verified.'''
+    entries, verified = [], []
+    for document, src_key in zip(documents, src_keys):
+        try:
+            entry = verify_cache.entry(document, src_key)
+        except (ValueError, TypeError, AttributeError):
+            entry = None
+        entries.append(entry)
+        verified.append(entry is not None and verify_cache.contains(entry) and _items_match(document))
+    verify_cache.hits   += sum(verified)
+    verify_cache.misses += len(verified) - sum(verified)
+    return entries, verified
+
+def _items_match(document):
+    ''' Cached signatures cover the Merkle root, the items are checked anyway.'''
+    try:
+        test_merkle_items(document)
+        return True
+    except ValueError:
+        return False
+
+def _cache_results(verify_cache, entries, verified, results):
+    ''' Adds the documents the workers verified to the cache.'''
+    for entry, was_verified, (value, _) in zip(entries, verified, results):
+        if entry is not None and not was_verified and value not in (None, False):
+            verify_cache.add(entry)
+
+def _run_chunked(function, items, executor, max_workers, chunk_size):
+    ''' Runs function over items in chunks, on a process pool if worth it,
+        and returns the flattened results in input order.'''
+    chunks = [items[start:start + chunk_size] for start in range(0, len(items), chunk_size)]
+    if len(chunks) <= 1:
+        return [result for chunk in chunks for result in function(chunk)]
+
+    if executor is not None:
+        chunk_results = list(executor.map(function, chunks))
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            chunk_results = list(pool.map(function, chunks))
+    return [result for chunk in chunk_results for result in chunk]
+
+def encrypt_many(json_objects, src_private_key, dst_public_key, sections_to_encrypt=None, mode='CBC',
+                 executor=None, max_workers=None, chunk_size=BATCH_CHUNK_SIZE, compress=None):
+    ''' Runs encrypt_json() over json_objects in parallel. dst_public_key may
+        be a single key or a list with one key per object.'''
+    dst_keys = _per_item(dst_public_key, len(json_objects))
+    src_pem  = _export_key(src_private_key)
+    items = [(json_object, src_pem, _export_key(dst_key), sections_to_encrypt, mode, compress)
+             for json_object, dst_key in zip(json_objects, dst_keys)]
+    return _run_chunked(_encrypt_chunk, items, executor, max_workers, chunk_size)
+
+def decrypt_many(encrypted_documents, src_public_key, dst_private_key, seen_nonces=None, freshness_check=True,
+                 executor=None, max_workers=None, chunk_size=BATCH_CHUNK_SIZE, verify_cache=None, only_sections=None):
+    ''' Runs decrypt_json() over encrypted_documents in parallel.
+        src_public_key may be a single key or a list with one key per
+        document. A nonce repeated inside the batch fails the freshness
+        check for every occurrence after the first.
+        
+        With a ReplayCache as seen_nonces, the nonces of the documents that
+        pass are recorded in it, in input order. only_sections is passed to
+        decrypt_json(), lazy documents cannot leave the workers.'''
+    src_keys = _per_item(src_public_key, len(encrypted_documents))
+    dst_pem  = _export_key(dst_private_key)
+    replay_cache = seen_nonces if hasattr(seen_nonces, 'check_and_add') else None
+    if replay_cache is not None:
+        # workers cannot share the cache, they see it empty and it is
+        # checked here once they are done
+        seen_nonces = set()
+    else:
+        seen_nonces = set(seen_nonces) if seen_nonces is not None else set()
+    if verify_cache is not None and src_public_key is not None:
+        entries, verified = _cache_entries(verify_cache, encrypted_documents, src_keys)
+    else:
+        entries, verified = None, [False] * len(encrypted_documents)
+    # a verified document is sent without its key, skipping the signature
+    items = [(_as_document(document), None if is_verified else _export_key(src_key), dst_pem,
+              seen_nonces, freshness_check, only_sections)
+             for document, src_key, is_verified in zip(encrypted_documents, src_keys, verified)]
+    results = _run_chunked(_decrypt_chunk, items, executor, max_workers, chunk_size)
+    if entries is not None:
+        _cache_results(verify_cache, entries, verified, results)
+
+    if freshness_check and replay_cache is not None:
+        for index, (json_object, nonce) in enumerate(results):
+            if json_object is None:
+                continue
+            timestamp = _as_envelope(encrypted_documents[index]).timestamp
+            if not replay_cache.check_and_add(nonce, timestamp):
+                _count_rejection('freshness')
+                results[index] = (None, "freshness check failed, nonce has been seen before")
+    elif freshness_check:
+        # workers only saw the nonces from before the batch
+        batch_nonces = set()
+        for index, (json_object, nonce) in enumerate(results):
+            if json_object is None:
+                continue
+            if nonce in batch_nonces:
+                results[index] = (None, "freshness check failed, nonce has been seen before")
+            batch_nonces.add(nonce)
+    return results
+
+def verify_many(encrypted_documents, src_public_key,
+                executor=None, max_workers=None, chunk_size=BATCH_CHUNK_SIZE, verify_cache=None):
+    ''' Runs test_json_hash() over encrypted_documents in parallel.
+        src_public_key may be a single key or a list with one key per
+        document. Ignores freshness.'''
+    src_keys = _per_item(src_public_key, len(encrypted_documents))
+    if verify_cache is None:
+        items = [(_as_document(document), _export_key(src_key))
+                 for document, src_key in zip(encrypted_documents, src_keys)]
+        return _run_chunked(_verify_chunk, items, executor, max_workers, chunk_size)
+
+    entries, verified = _cache_entries(verify_cache, encrypted_documents, src_keys)
+    pending = [index for index, is_verified in enumerate(verified) if not is_verified]
+    items = [(_as_document(encrypted_documents[index]), _export_key(src_keys[index])) for index in pending]
+    results = [(True, None)] * len(encrypted_documents)
+    for index, result in zip(pending, _run_chunked(_verify_chunk, items, executor, max_workers, chunk_size)):
+        results[index] = result
+    _cache_results(verify_cache, entries, verified, results)
+    return results
+
+def check_many(encrypted_documents, src_public_key, seen_nonces=None, freshness_check=True,
+               executor=None, max_workers=None, chunk_size=BATCH_CHUNK_SIZE, verify_cache=None):
+    ''' Runs check_json() over encrypted_documents in parallel, nothing is
+        decrypted. src_public_key may be a single key or a list with one key
+        per document, documents without one are invalid. A nonce found in
+        seen_nonces, a set or a replay store, or repeated inside the batch
+        fails the freshness check. Nothing is recorded in seen_nonces.'''
+    src_keys = _per_item(src_public_key, len(encrypted_documents))
+    if verify_cache is not None and src_public_key is not None:
+        entries, verified = _cache_entries(verify_cache, encrypted_documents, src_keys)
+    else:
+        entries, verified = None, [False] * len(encrypted_documents)
+    # a verified document is sent without its key, flagged to skip the signature
+    items = [(_as_document(document), None if is_verified else _export_key(src_key), freshness_check, is_verified)
+             for document, src_key, is_verified in zip(encrypted_documents, src_keys, verified)]
+    results = _run_chunked(_check_chunk, items, executor, max_workers, chunk_size)
+    if entries is not None:
+        _cache_results(verify_cache, entries, verified, results)
+
+    if freshness_check:
+        # workers only checked the timestamps, nonces are looked up here
+        batch_nonces = set()
+        for index, (valid, nonce) in enumerate(results):
+            if valid is None:
+                continue
+            if nonce in batch_nonces or (seen_nonces is not None and nonce in seen_nonces):
+                _count_rejection('freshness')
+                results[index] = (None, "freshness check failed, nonce has been seen before")
+            batch_nonces.add(nonce)
+    return results
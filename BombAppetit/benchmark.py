@@ -0,0 +1,199 @@
+
+import sys
+import json
+import math
+import time
+import random
+import platform
+import argparse
+from datetime import datetime
+
+import Crypto
+
+from .functions import encrypt_json, decrypt_json, test_json_hash, create_keypair
+
+
+# -- micro-benchmark suite --
+#
+# Times encrypt_json(), decrypt_json() and test_json_hash() over a sweep of
+# payload sizes, RSA key sizes and section layouts, and reports ops/sec and
+# p50/p99 latency per case. Results are saved as JSON baselines that a later
+# run can be compared against:
+#
+#     python3 -m BombAppetit.benchmark --output baseline.json
+#     python3 -m BombAppetit.benchmark --compare baseline.json
+#
+# Payloads are synthetic and seeded, so runs are reproducible.
+#
+
+KEY_SIZES = (2048, 4096)
+
+PAYLOADS = ('user_op', 'restaurant', 'list_50', 'list_500')
+
+# layout -> (use destination key, sections to encrypt)
+LAYOUTS = { 'signed':   (False, []),
+            'sections': (True,  ['mealVouchers']),
+            'full':     (True,  None), }
+
+OPERATIONS = ('encrypt', 'decrypt', 'verify')
+
+_GENRES     = ['Portuguese', 'Traditional', 'Italian', 'Seafood', 'Vegetarian', 'Grill']
+_CATEGORIES = ['Meat', 'Fish', 'Vegetarian', 'Dessert', 'Drink']
+
+def synthetic_restaurant(index, menu_items=10, rng=None):
+    ''' Returns a restaurant shaped like Client/restaurantInfo/*.json.'''
+    rng = rng if rng is not None else random.Random(index)
+    return {
+        'owner':      f'Owner {index}',
+        'restaurant': f'Restaurant {index}',
+        'address':    f'Rua {rng.randint(1, 500)}, {rng.randint(1, 99)}, Lisboa',
+        'genre':      rng.sample(_GENRES, 2),
+        'menu': [{
+            'itemName':    f'Dish {index}-{item}',
+            'category':    rng.choice(_CATEGORIES),
+            'description': 'A house speciality prepared with seasonal ingredients. ' * rng.randint(1, 3),
+            'price':       round(rng.uniform(2, 40), 2),
+            'currency':    'EUR',
+        } for item in range(menu_items)],
+        'mealVouchers': [{
+            'code':        f'VOUCHER{index}{voucher}',
+            'description': 'Redeem this code for a 20% discount in the meal.',
+        } for voucher in range(2)],
+    }
+
+def make_payload(name):
+    ''' Returns the JSON object of payload name, see PAYLOADS.'''
+    rng = random.Random(name)
+    if name == 'user_op':
+        return { 'user_name': 'bench', 'user_name_to_read': 'other', 'operation': 'read',
+                 'mealVouchers': [] }
+    if name == 'restaurant':
+        return synthetic_restaurant(0, rng=rng)
+    if name.startswith('list_'):
+        count = int(name[len('list_'):])
+        return { 'restaurants': [{ 'id': index, 'data': synthetic_restaurant(index, rng=rng) }
+                                 for index in range(count)],
+                 'mealVouchers': [] }
+    raise ValueError(f"Unknown payload '{name}'")
+
+def percentile(samples, fraction):
+    ''' Nearest-rank percentile of a sorted list of samples.'''
+    rank = max(1, math.ceil(fraction * len(samples)))
+    return samples[rank - 1]
+
+def summarize(samples):
+    ''' Returns ops/sec and latency percentiles, in milliseconds, of a list
+        of durations in seconds.'''
+    samples = sorted(samples)
+    total = sum(samples)
+    return { 'iterations': len(samples),
+             'ops_per_sec': len(samples) / total if total else 0.0,
+             'mean_ms': 1000 * total / len(samples),
+             'p50_ms':  1000 * percentile(samples, 0.50),
+             'p99_ms':  1000 * percentile(samples, 0.99), }
+
+def time_operation(function, iterations, warmup):
+    ''' Runs function warmup times untimed, then iterations times timed.'''
+    for _ in range(warmup):
+        function()
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+def run_case(json_object, private_key, public_key, layout, iterations, warmup):
+    ''' Times every operation of one case, returns {operation: summary}.'''
+    use_dst, sections = LAYOUTS[layout]
+    dst_public_key  = public_key  if use_dst else None
+    dst_private_key = private_key if use_dst else None
+
+    document = encrypt_json(json_object, private_key, dst_public_key, sections)
+    # a case that does not round-trip is broken, not slow
+    decrypted, _ = decrypt_json(document, public_key, dst_private_key, freshness_check=False)
+    if decrypted != json_object:
+        raise ValueError(f"Layout '{layout}' does not round-trip")
+    return {
+        'encrypt': summarize(time_operation(
+            lambda: encrypt_json(json_object, private_key, dst_public_key, sections), iterations, warmup)),
+        'decrypt': summarize(time_operation(
+            lambda: decrypt_json(document, public_key, dst_private_key, freshness_check=False), iterations, warmup)),
+        'verify':  summarize(time_operation(
+            lambda: test_json_hash(document, public_key), iterations, warmup)),
+    }
+
+def run_suite(key_sizes=KEY_SIZES, payloads=PAYLOADS, layouts=tuple(LAYOUTS), iterations=50, warmup=3, out=sys.stdout):
+    ''' Runs every combination and returns the results as a JSON object.'''
+    results = {}
+    for key_size in key_sizes:
+        private_key, public_key = create_keypair(key_size)
+        for payload in payloads:
+            json_object = make_payload(payload)
+            size = len(json.dumps(json_object))
+            for layout in layouts:
+                case = f'{payload}/rsa{key_size}/{layout}'
+                results[case] = run_case(json_object, private_key, public_key, layout, iterations, warmup)
+                results[case]['payload_bytes'] = size
+                if out is not None:
+                    print_case(case, results[case], out)
+
+    return { 'meta': { 'date':        datetime.utcnow().isoformat(),
+                       'python':      platform.python_version(),
+                       'pycryptodome': Crypto.__version__,
+                       'machine':     platform.machine(),
+                       'processor':   platform.processor(),
+                       'iterations':  iterations, },
+             'results': results, }
+
+def print_case(case, result, out=sys.stdout):
+    for operation in OPERATIONS:
+        summary = result[operation]
+        print(f"{case:32} {operation:8} {summary['ops_per_sec']:10.1f} ops/s"
+              f"  p50 {summary['p50_ms']:8.3f} ms  p99 {summary['p99_ms']:8.3f} ms", file=out)
+
+def compare(baseline, current, out=sys.stdout):
+    ''' Prints the ops/sec change of every case present in both runs.
+        Returns the changes as {case: {operation: fraction}}.'''
+    changes = {}
+    for case, result in current['results'].items():
+        if case not in baseline['results']:
+            continue
+        changes[case] = {}
+        for operation in OPERATIONS:
+            before = baseline['results'][case][operation]['ops_per_sec']
+            after  = result[operation]['ops_per_sec']
+            change = (after - before) / before if before else 0.0
+            changes[case][operation] = change
+            print(f"{case:32} {operation:8} {before:10.1f} -> {after:10.1f} ops/s  {change:+7.1%}", file=out)
+    return changes
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='BombAppetit micro-benchmarks.')
+    parser.add_argument('--key-sizes', default=','.join(map(str, KEY_SIZES)), help='Comma-separated RSA key sizes')
+    parser.add_argument('--payloads', default=','.join(PAYLOADS), help='Comma-separated payloads')
+    parser.add_argument('--layouts', default=','.join(LAYOUTS), help='Comma-separated section layouts')
+    parser.add_argument('--iterations', type=int, default=50, help='Timed iterations per operation')
+    parser.add_argument('--warmup', type=int, default=3, help='Untimed iterations per operation')
+    parser.add_argument('--output', help='Write results as JSON to this file')
+    parser.add_argument('--compare', help='Baseline JSON to compare the results against')
+    args = parser.parse_args(argv)
+
+    results = run_suite(key_sizes=[int(size) for size in args.key_sizes.split(',')],
+                        payloads=args.payloads.split(','),
+                        layouts=args.layouts.split(','),
+                        iterations=args.iterations,
+                        warmup=args.warmup)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        print()
+        compare(baseline, results)
+
+if __name__ == '__main__':
+    main()
@@ -1,21 +1,48 @@
 
 import sys
 import json
+import zlib
+import lzma
+import struct
+import binascii
+import hashlib
+import weakref
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
 from datetime import datetime
 from base64 import b64encode, b64decode
 
 from Crypto.Cipher       import AES, PKCS1_v1_5
-from Crypto.Hash         import SHA256
-from Crypto.PublicKey    import RSA
+from Crypto.Hash         import HMAC, SHA256
+from Crypto.Protocol.DH  import key_agreement
+from Crypto.Protocol.KDF import HKDF
+from Crypto.PublicKey    import ECC, RSA
 from Crypto.Random       import get_random_bytes
-from Crypto.Signature    import pkcs1_15
-from Crypto.Util.Padding import pad, unpad
+from Crypto.Signature    import eddsa, pkcs1_15
 
+from .instrument import phase as _phase
+
+
+# keypairs are taken from this pool when set, see keypool.KeyPool
+key_pool = None
+
+def set_key_pool(pool):
+    ''' Makes create_key_pair() and create_keypair() take keys from pool,
+        None goes back to generating them inline.'''
+    global key_pool
+    key_pool = pool
+
+def _generate_rsa(key_size):
+    ''' Returns a RSA private key, from key_pool if set.'''
+    if key_pool is not None:
+        return key_pool.take(key_size)[0]
+    return RSA.generate(key_size)
 
 def create_key_pair(key_size, public_key_path, private_key_path):
     ''' Creates a RSA key pair of the given key_size in bytes and writes the public key and private key to separate files. '''
     try:
-        key = RSA.generate(key_size)
+        key = _generate_rsa(key_size)
     except ValueError:
         print(f"ERROR: Invalid key size '{key_size}'.", file=sys.stderr)
         exit(1)
@@ -61,164 +88,1359 @@ def load_public_key(public_key_path):
 #                          'timestamp':             seconds in float with microsecond precision,
 #                          'nonce':                 str,
 #                          'encrypted_sections':    list,
-#                          'fully_encrypted':       bool
+#                          'fully_encrypted':       bool,
+#                          'mode':                  'CBC' or 'GCM',
+#                          'compression':           optional, see compression below
 #                      },
-#     'encrypted_key': base64(rsa_encrypt(AES_key + AES_IV)),
+#     'encrypted_key': base64(rsa_encrypt(AES_key + AES_IV)), only AES_key in GCM mode
 #     'signature':     base64(rsa_sign(sha256(content))),
 # }
 #
+# -- version 2 documents, Ed25519/X25519 suite --
+#
+# encrypted_document = {
+#     'version':       2,
+#     'content':       str of { same as above },
+#     'ephemeral_key': base64(ephemeral public key), AES key and IV are
+#                      HKDF(ECDH(ephemeral, destination key)),
+#     'signature':     base64(ed25519_sign(content)),
+# }
+#
+# Documents without a version are version 1, the RSA suite. The suite is
+# picked from the type of the keys given to encrypt_json().
+#
+# -- multi-recipient documents, RSA suite only --
+#
+# Given a list of destination keys, encrypt_json() encrypts the content once
+# and wraps its key for each of them, 'encrypted_key' is replaced by
+#
+#     'encrypted_keys': { key_fingerprint(dst_public_key): base64(rsa_encrypt(AES_key + AES_IV)), ... }
+#
+# and decrypt_json() unwraps the entry of its own key.
+#
+# -- session documents, see Session below --
+#
+# session_document = {
+#     'content':       str of { same as above, 'mode' is always 'GCM' },
+#     'session':       session id,
+#     'mac':           base64(hmac_sha256(session mac key, content)),
+# }
+#
+# In GCM mode every encrypted value is base64(nonce + ciphertext + tag) and is
+# authenticated together with its section name, so sections are independent
+# and can be decrypted in any order. A fully encrypted JSON is a list of such
+# values, one per GCM_CHUNK_SIZE bytes of plaintext, each bound to its index
+# and the chunk count so chunks cannot be reordered or dropped.
+#
+
+SUITE_RSA     = 1
+SUITE_ED25519 = 2
+
+def _suite_of(key):
+    ''' Returns the cipher suite version a key belongs to.'''
+    return SUITE_ED25519 if isinstance(key, ECC.EccKey) else SUITE_RSA
+
+def _ecdh_kdf(ephemeral_key):
+    ''' Returns the HKDF used to turn the ECDH secret into AES key and IV,
+        salted with the ephemeral public key.'''
+    def kdf(secret):
+        return HKDF(secret, 32 + 16, ephemeral_key, SHA256, context=b'BombAppetit v2')
+    return kdf
+
+def _ecdh_wrap(dst_public_key):
+    ''' Derives a fresh AES key and IV for dst_public_key. Returns them and
+        the ephemeral public key the recipient needs to derive them too.'''
+    with _phase('ecdh'):
+        ephemeral = ECC.generate(curve='ed25519')
+        ephemeral_key = ephemeral.public_key().export_key(format='raw')
+        gen_key_iv = key_agreement(eph_priv=ephemeral, static_pub=dst_public_key, kdf=_ecdh_kdf(ephemeral_key))
+    return gen_key_iv[:32], gen_key_iv[32:], ephemeral_key
+
+def _ecdh_unwrap(dst_private_key, ephemeral_key):
+    ''' Derives the AES key and IV of a version 2 document.'''
+    with _phase('ecdh'):
+        ephemeral = eddsa.import_public_key(ephemeral_key)
+        gen_key_iv = key_agreement(static_priv=dst_private_key, eph_pub=ephemeral, kdf=_ecdh_kdf(ephemeral_key))
+    return gen_key_iv[:32], gen_key_iv[32:]
+
+GCM_NONCE_SIZE = 12
+GCM_TAG_SIZE   = 16
+GCM_CHUNK_SIZE = 64 * 1024
+
+
+# -- bytes-native AES --
+#
+# encrypt_bytes() and decrypt_bytes() take any bytes-like object (bytes,
+# bytearray, memoryview) and return a bytearray. Each call allocates its
+# output once: CBC pads and encrypts in place in that buffer, GCM writes
+# nonce, ciphertext and tag straight into it, and decryption unpads by
+# truncating it. encrypt_json()/decrypt_json() run every section through
+# the same helpers and only base64 encode at the JSON boundary.
+#
+# CBC:  IV (16 bytes) + ciphertext of the PKCS#7 padded data, without the
+#       IV if the caller passes its own iv, and then the same iv to decrypt
+# GCM:  nonce (12 bytes) + ciphertext + tag (16 bytes)
+#
+
+def _cbc_encrypt(cipher, data, prefix=b''):
+    ''' Pads data into a new buffer, after prefix, and encrypts it there with
+        cipher.'''
+    start   = len(prefix)
+    length  = len(data)
+    padding = AES.block_size - length % AES.block_size
+    buffer  = bytearray(start + length + padding)
+    buffer[:start] = prefix
+    buffer[start:start + length] = data
+    buffer[start + length:] = bytes((padding,)) * padding
+    view = memoryview(buffer)[start:]
+    cipher.encrypt(view, output=view)
+    return buffer
+
+def _cbc_decrypt(cipher, data):
+    ''' Decrypts data with cipher into a new buffer and unpads it there.'''
+    if not len(data) or len(data) % AES.block_size:
+        raise ValueError("Data must be padded to 16 byte boundary in CBC mode")
+    buffer = bytearray(len(data))
+    cipher.decrypt(data, output=buffer)
+    padding = buffer[-1]
+    if not 1 <= padding <= AES.block_size or buffer[-padding:] != bytes((padding,)) * padding:
+        raise ValueError("Padding is incorrect.")
+    del buffer[-padding:]
+    return buffer
+
+def _gcm_decrypt_into(key, view, associated_data, output):
+    ''' Decrypts nonce + ciphertext + tag in view into output, a writable
+        buffer of the plaintext size, and checks the tag.'''
+    cipher = AES.new(key, AES.MODE_GCM, nonce=view[:GCM_NONCE_SIZE])
+    cipher.update(associated_data)
+    cipher.decrypt(view[GCM_NONCE_SIZE:-GCM_TAG_SIZE], output=output)
+    cipher.verify(view[-GCM_TAG_SIZE:])
+
+def encrypt_bytes(data, key, mode='CBC', iv=None, associated_data=b''):
+    ''' Encrypts bytes-like data with AES under key, see the formats above.
+        iv is only used in CBC mode, associated_data only in GCM mode.'''
+    if mode == 'CBC':
+        if iv is not None:
+            return _cbc_encrypt(AES.new(key, AES.MODE_CBC, iv), data)
+        cipher = AES.new(key, AES.MODE_CBC)
+        return _cbc_encrypt(cipher, data, prefix=cipher.iv)
+    if mode != 'GCM':
+        raise ValueError(f"Invalid mode '{mode}'")
+
+    length = len(data)
+    buffer = bytearray(GCM_NONCE_SIZE + length + GCM_TAG_SIZE)
+    buffer[:GCM_NONCE_SIZE] = get_random_bytes(GCM_NONCE_SIZE)
+    cipher = AES.new(key, AES.MODE_GCM, nonce=buffer[:GCM_NONCE_SIZE])
+    cipher.update(associated_data)
+    cipher.encrypt(data, output=memoryview(buffer)[GCM_NONCE_SIZE:GCM_NONCE_SIZE + length])
+    buffer[GCM_NONCE_SIZE + length:] = cipher.digest()
+    return buffer
+
+def decrypt_bytes(data, key, mode='CBC', iv=None, associated_data=b''):
+    ''' Reverses encrypt_bytes(), raises ValueError if the padding or the GCM
+        tag is wrong. Without iv, CBC data starts with its IV.'''
+    if mode == 'CBC':
+        if iv is not None:
+            return _cbc_decrypt(AES.new(key, AES.MODE_CBC, iv), data)
+        view = memoryview(data)
+        if len(view) < AES.block_size:
+            raise ValueError("Ciphertext too short")
+        return _cbc_decrypt(AES.new(key, AES.MODE_CBC, view[:AES.block_size]), view[AES.block_size:])
+    if mode != 'GCM':
+        raise ValueError(f"Invalid mode '{mode}'")
+
+    view = memoryview(data)
+    if len(view) < GCM_NONCE_SIZE + GCM_TAG_SIZE:
+        raise ValueError("Ciphertext too short")
+    buffer = bytearray(len(view) - GCM_NONCE_SIZE - GCM_TAG_SIZE)
+    _gcm_decrypt_into(key, view, associated_data, buffer)
+    return buffer
+
+def _b64encode(data):
+    ''' Encodes bytes-like data as base64 text.'''
+    return binascii.b2a_base64(data, newline=False).decode('ascii')
+
+def _b64decode(text):
+    ''' Decodes base64 text, str or bytes, without encoding it first.'''
+    return binascii.a2b_base64(text)
+
+def _gcm_encrypt(key, data, section):
+    ''' Encrypts data with AES-GCM under a fresh nonce, binding it to the
+        section name. Returns base64(nonce + ciphertext + tag).'''
+    with _phase('aes', len(data)):
+        raw = encrypt_bytes(data, key, 'GCM', associated_data=section.encode('utf-8'))
+    with _phase('base64', len(raw)):
+        return _b64encode(raw)
+
+def _gcm_decrypt(key, encrypted_content, section):
+    ''' Reverses _gcm_encrypt(), raises ValueError if the tag does not match.'''
+    with _phase('base64', len(encrypted_content)):
+        raw = _b64decode(encrypted_content)
+    with _phase('aes', len(raw)):
+        return decrypt_bytes(raw, key, 'GCM', associated_data=section.encode('utf-8'))
+
+def _gcm_encrypt_chunks(key, data):
+    ''' Encrypts data as a list of independent GCM_CHUNK_SIZE chunks.'''
+    view   = memoryview(data)
+    starts = range(0, max(len(view), 1), GCM_CHUNK_SIZE)
+    return [_gcm_encrypt(key, view[start:start + GCM_CHUNK_SIZE], f'{index}/{len(starts)}')
+            for index, start in enumerate(starts)]
+
+def _gcm_decrypt_chunks(key, encrypted_chunks):
+    ''' Reverses _gcm_encrypt_chunks(), decrypting into a single buffer.'''
+    overhead = GCM_NONCE_SIZE + GCM_TAG_SIZE
+    with _phase('base64', sum(len(chunk) for chunk in encrypted_chunks)):
+        raws = [memoryview(_b64decode(chunk)) for chunk in encrypted_chunks]
+    if any(len(raw) < overhead for raw in raws):
+        raise ValueError("Ciphertext too short")
+
+    buffer = bytearray(sum(len(raw) for raw in raws) - overhead * len(raws))
+    view   = memoryview(buffer)
+    offset = 0
+    with _phase('aes', len(buffer)):
+        for index, raw in enumerate(raws):
+            size = len(raw) - overhead
+            _gcm_decrypt_into(key, raw, f'{index}/{len(raws)}'.encode('utf-8'), view[offset:offset + size])
+            offset += size
+    return buffer
+
+
+# -- compression --
+#
+# With compress='zlib' or 'lzma', encrypt_json() compresses every encrypted
+# section, or the whole JSON, before AES if its plaintext is at least
+# COMPRESS_THRESHOLD bytes and compressing makes it smaller. The content then
+# records which ones were compressed:
+#
+#     'compression': { 'algorithm': 'zlib' or 'lzma',
+#                      'sections':  [section names, '' for the whole JSON] }
+#
+# and decrypt_json() decompresses them, refusing to inflate any of them past
+# max_decompressed_size. The compressed length says something about the
+# plaintext, do not compress sections mixing secrets with attacker input.
+#
+
+COMPRESS_THRESHOLD    = 1024              # bytes of plaintext
+MAX_DECOMPRESSED_SIZE = 64 * 1024 * 1024  # bytes per section
+
+COMPRESSION_ALGORITHMS = ('zlib', 'lzma')
+
+def _compress(data, algorithm):
+    ''' Compresses bytes-like data with algorithm.'''
+    if algorithm == 'zlib':
+        return zlib.compress(data)
+    if algorithm == 'lzma':
+        return lzma.compress(data)
+    raise ValueError(f"Unsupported compression '{algorithm}'")
+
+def _decompress(data, algorithm, max_size):
+    ''' Reverses _compress(), raises ValueError if data is corrupt or would
+        decompress to more than max_size bytes.'''
+    if algorithm == 'zlib':
+        decompressor, error = zlib.decompressobj(), zlib.error
+    elif algorithm == 'lzma':
+        decompressor, error = lzma.LZMADecompressor(), lzma.LZMAError
+    else:
+        raise ValueError(f"Unsupported compression '{algorithm}'")
+
+    try:
+        # stops one byte past the limit, a bomb is never inflated in full
+        output = decompressor.decompress(data, max_size + 1)
+    except error as e:
+        raise ValueError(f"Compressed data is corrupt: {e}")
+    if len(output) > max_size:
+        raise ValueError("Decompressed data is too large")
+    if not decompressor.eof:
+        raise ValueError("Compressed data is truncated")
+    return output
+
+
+# -- session mode --
+#
+# The RSA signature, verification and key wrap on every request dominate
+# server CPU. On login the server creates a Session and sends its key to the
+# client wrapped with the client's public key (a normal encrypt_json()). After
+# that both sides pass the Session to encrypt_json()/decrypt_json(), which then
+# authenticate with HMAC-SHA256 and encrypt with AES-GCM under keys derived
+# from the session key. Nonce and timestamp freshness rules are unchanged.
+#
+
+SESSION_LIFETIME = 60 * 60 # seconds
+
+class Session:
+    ''' Symmetric session shared by client and server after login.'''
+    def __init__(self, session_id, session_key, created=None):
+        self.session_id  = session_id
+        self.session_key = session_key
+        self.created     = created if created is not None else datetime.utcnow().timestamp()
+
+        # independent keys for encryption and authentication
+        self.enc_key = HMAC.new(session_key, b'BombAppetit enc', SHA256).digest()
+        self.mac_key = HMAC.new(session_key, b'BombAppetit mac', SHA256).digest()
+
+    def expired(self):
+        ''' Returns True if the session is older than SESSION_LIFETIME.'''
+        return datetime.utcnow().timestamp() > self.created + SESSION_LIFETIME
+
+    def export(self):
+        ''' Returns the session as a JSON object, to be sent encrypted.'''
+        return { 'session_id':  self.session_id,
+                 'session_key': self.session_key.hex(), }
+
+def create_session():
+    ''' Creates a new Session with a random id and 256 bit key.'''
+    return Session(get_random_bytes(16).hex(), get_random_bytes(32))
+
+def load_session(exported):
+    ''' Creates a Session from the output of Session.export().'''
+    return Session(exported['session_id'], bytes.fromhex(exported['session_key']))
+
+
+# -- Merkle list documents --
+#
+# With merkle_section, encrypt_json() moves the list in that section out of
+# the signed content:
+#
+# merkle_document = {
+#     'content':       str of { same as above, the section removed from json,
+#                          'merkle': { 'section': section name,
+#                                      'count':   number of items,
+#                                      'root':    hex Merkle root of the items },
+#                      },
+#     'items':         [ fragment, ... ],
+#     'signature' or 'mac', and the other fields, as above,
+# }
+#
+# fragment = { 'content': str of the item JSON, 'signature': base64(sign(content)) }
+#
+# The signature only covers the content, so its cost does not grow with the
+# list. Items are bound to it by the root, hashed as in RFC 6962: leaves are
+# sha256(0x00 + item content), nodes sha256(0x01 + left + right). Fragments
+# are made once with sign_fragment() (or make_fragment(), unsigned) and can be
+# stored as they are; a single item can be checked with test_fragment() or,
+# without the rest of the list, with merkle_proof()/verify_merkle_proof().
+#
+
+def make_fragment(json_object):
+    ''' Returns an unsigned fragment of json_object.'''
+    return { 'content': json.dumps(json_object) }
+
+def sign_fragment(json_object, src_private_key):
+    ''' Returns a fragment of json_object signed with src_private_key.'''
+    fragment = make_fragment(json_object)
+    content_bytes = fragment['content'].encode('utf-8')
+    if _suite_of(src_private_key) == SUITE_ED25519:
+        with _phase('ed25519_sign', len(content_bytes)):
+            signature = eddsa.new(src_private_key, 'rfc8032').sign(content_bytes)
+    else:
+        with _phase('rsa_sign'):
+            signature = pkcs1_15.new(src_private_key).sign(SHA256.new(content_bytes))
+    fragment['signature'] = b64encode(signature).decode('utf-8')
+    return fragment
+
+def test_fragment(fragment, src_public_key):
+    ''' Tests the signature of a fragment. Raises ValueError if invalid.'''
+    if 'signature' not in fragment:
+        raise ValueError("Fragment is not signed")
+    content_bytes = fragment['content'].encode('utf-8')
+    signature = b64decode(fragment['signature'].encode())
+    if _suite_of(src_public_key) == SUITE_ED25519:
+        with _phase('ed25519_verify', len(content_bytes)):
+            eddsa.new(src_public_key, 'rfc8032').verify(content_bytes, signature)
+    else:
+        with _phase('rsa_verify'):
+            pkcs1_15.new(src_public_key).verify(SHA256.new(content_bytes), signature)
+
+def fragment_digest(fragment):
+    ''' Returns the Merkle leaf hash of a fragment.'''
+    return hashlib.sha256(b'\x00' + fragment['content'].encode('utf-8')).digest()
+
+def _merkle_node(left, right):
+    return hashlib.sha256(b'\x01' + left + right).digest()
+
+def merkle_root(leaves):
+    ''' Returns the Merkle root of a list of leaf hashes. A node without a
+        sibling moves up unchanged, which gives the RFC 6962 tree.'''
+    if not leaves:
+        return hashlib.sha256(b'').digest()
+    level = list(leaves)
+    while len(level) > 1:
+        paired = [_merkle_node(level[i], level[i + 1]) for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            paired.append(level[-1])
+        level = paired
+    return level[0]
+
+def merkle_proof(leaves, index):
+    ''' Returns the audit path of leaves[index], as a list of hex hashes.'''
+    proof = []
+    level = list(leaves)
+    while len(level) > 1:
+        sibling = index ^ 1
+        if sibling < len(level):
+            proof.append(level[sibling].hex())
+        paired = [_merkle_node(level[i], level[i + 1]) for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            paired.append(level[-1])
+        level = paired
+        index //= 2
+    return proof
+
+def verify_merkle_proof(fragment, index, count, proof, root):
+    ''' Checks fragment is item index of count under the hex root, using a
+        proof from merkle_proof().'''
+    node = fragment_digest(fragment)
+    proof = [bytes.fromhex(sibling) for sibling in proof]
+    while count > 1:
+        if index % 2:
+            if not proof:
+                return False
+            node = _merkle_node(proof.pop(0), node)
+        elif index + 1 < count:
+            if not proof:
+                return False
+            node = _merkle_node(node, proof.pop(0))
+        index //= 2
+        count = (count + 1) // 2
+    return not proof and node.hex() == root
+
+def test_merkle_items(encrypted_document):
+    ''' Tests the items of a Merkle document against the root in its signed
+        content. Raises ValueError if they do not match, does nothing for
+        other documents.'''
+    envelope = _as_envelope(encrypted_document)
+    merkle = envelope.merkle
+    if merkle is None:
+        return
+    items = envelope.get('items')
+    if not isinstance(items, list) or len(items) != merkle.get('count'):
+        raise ValueError("Merkle items do not match the signed count")
+    try:
+        with _phase('sha256', sum(len(item['content']) for item in items)):
+            root = merkle_root([fragment_digest(item) for item in items])
+    except (KeyError, TypeError, AttributeError):
+        raise ValueError("Malformed Merkle items")
+    if root.hex() != merkle.get('root'):
+        raise ValueError("Merkle items do not match the signed root")
+
+
+# -- staged validation --
+#
+# decrypt_json() rejects documents in order of cost: size limit, header
+# parse, nonce and timestamp, signature or MAC (public key or HMAC only), key
+# unwrap (the private key operation) and finally AES. Rejections are counted
+# per stage in rejection_counts.
+#
+
+MAX_DOCUMENT_SIZE = 16 * 1024 * 1024 # bytes of content
+
+FRESHNESS_WINDOW = 60 # seconds a timestamp may be off, either way
+
+REJECTION_STAGES = ('size', 'header', 'freshness', 'signature', 'unwrap', 'decrypt')
+
+rejection_counts = dict.fromkeys(REJECTION_STAGES, 0)
+_rejection_lock  = threading.Lock()
+
+def _count_rejection(stage):
+    with _rejection_lock:
+        rejection_counts[stage] += 1
+
+def get_rejection_counts():
+    ''' Returns a copy of the per-stage rejection counters.'''
+    with _rejection_lock:
+        return dict(rejection_counts)
+
+def reset_rejection_counts():
+    ''' Sets every per-stage rejection counter back to zero.'''
+    with _rejection_lock:
+        for stage in REJECTION_STAGES:
+            rejection_counts[stage] = 0
+
+def _document_size(encrypted_document):
+    ''' Returns the size of a document's content without parsing it.'''
+    if isinstance(encrypted_document, (bytes, bytearray, memoryview)):
+        return len(encrypted_document)
+    content = encrypted_document.get('content')
+    size = len(content) if isinstance(content, str) else 0
+    items = encrypted_document.get('items')
+    if isinstance(items, list):
+        size += sum(len(item.get('content', '')) for item in items if isinstance(item, dict))
+    return size
+
+
+# -- parsed envelope --
+#
+# Envelope parses the content of an encrypted document once and keeps the
+# parsed header, the encoded content and its SHA256 digest around, so the
+# server can look at user_name/nonce/timestamp before decrypting and
+# decrypt_json()/test_json_hash() do not parse or encode it again.
+#
+
+class Envelope:
+    ''' Parsed view of an encrypted document, in dict or binary form.
+        Exposes the header fields without decrypting anything.'''
+    __slots__ = ('document', 'content', 'root_json', '_content_bytes', '_digest')
+
+    def __init__(self, encrypted_document):
+        if isinstance(encrypted_document, (bytes, bytearray, memoryview)):
+            encrypted_document = unpack_document(encrypted_document)
+        self.document  = encrypted_document
+        self.content   = encrypted_document.get('content')
+        self.root_json = json.loads(self.content)
+        self._content_bytes = None
+        self._digest        = None
+
+        if not _valid_header(self.root_json):
+            raise ValueError("Malformed document header")
+
+    def get(self, name, default=None):
+        ''' Returns a field of the outer document, like dict.get().'''
+        return self.document.get(name, default)
+
+    def __contains__(self, name):
+        return name in self.document
+
+    @property
+    def content_bytes(self):
+        ''' The UTF-8 encoded content, what signatures and MACs cover.'''
+        if self._content_bytes is None:
+            self._content_bytes = self.content.encode('utf-8')
+        return self._content_bytes
+
+    @property
+    def digest(self):
+        ''' SHA256 hash object of the content, computed once.'''
+        if self._digest is None:
+            self._digest = SHA256.new(self.content_bytes)
+        return self._digest
+
+    @property
+    def json(self):
+        ''' The JSON as sent, encrypted sections still encrypted.'''
+        return self.root_json['json']
 
-def encrypt_json(json_object, src_private_key, dst_public_key, sections_to_encrypt=None):
+    @property
+    def user_name(self):
+        ''' The plaintext user_name of the JSON, None if absent or encrypted.'''
+        if self.root_json.get('fully_encrypted') or not isinstance(self.json, dict):
+            return None
+        return self.json.get('user_name')
+
+    @property
+    def nonce(self):
+        return self.root_json['nonce']
+
+    @property
+    def timestamp(self):
+        return self.root_json['timestamp']
+
+    @property
+    def encrypted_sections(self):
+        return self.root_json['encrypted_sections']
+
+    @property
+    def fully_encrypted(self):
+        return self.root_json['fully_encrypted']
+
+    @property
+    def mode(self):
+        return self.root_json.get('mode', 'CBC')
+
+    @property
+    def version(self):
+        return self.document.get('version', SUITE_RSA)
+
+    @property
+    def session(self):
+        return self.document.get('session')
+
+    @property
+    def merkle(self):
+        return self.root_json.get('merkle')
+
+    @property
+    def compression(self):
+        return self.root_json.get('compression')
+
+def _valid_header(root_json):
+    ''' Checks the parsed content has the fields decrypt_json() relies on.'''
+    return (isinstance(root_json, dict)
+            and 'json' in root_json
+            and isinstance(root_json.get('nonce'), str)
+            and isinstance(root_json.get('timestamp'), (int, float))
+            and isinstance(root_json.get('encrypted_sections'), list)
+            and isinstance(root_json.get('fully_encrypted'), bool))
+
+def _as_envelope(encrypted_document):
+    ''' Returns encrypted_document as an Envelope, parsing it if needed.'''
+    if isinstance(encrypted_document, Envelope):
+        return encrypted_document
+    return Envelope(encrypted_document)
+
+
+def encrypt_json(json_object, src_private_key, dst_public_key, sections_to_encrypt=None, session=None, mode='CBC',
+                 merkle_section=None, compress=None):
     ''' Encrypts content using generated AES key, AES key will be encrypted
         with dst_public_key for confidentiality, the contents will be hashed,
         for integrity, and signed using src_private_key, for authenticity.
         
         sections_to_encrypt is a list of strings, each string is a key name of
         the JSON that should be encrypted. If sections_to_encrypt is None,
-        the entire JSON will be encrypted, unless dst_public_key is None.'''
+        the entire JSON will be encrypted, unless dst_public_key is None.
+        
+        mode is 'CBC' or 'GCM'. In GCM mode every section gets its own nonce
+        and tag, so sections can be decrypted and checked independently.
+        
+        If session is given, the document is authenticated and encrypted with
+        the session keys instead, dst_public_key then only tells whether to
+        encrypt and src_private_key is not used.
+        
+        dst_public_key may also be a list of RSA keys, the content is then
+        encrypted once and its key wrapped for every one of them.
+        
+        If merkle_section is given, json_object[merkle_section] must be a
+        list of fragments, they are sent in clear next to the content and
+        only their Merkle root is signed, see make_fragment().
+        
+        compress is None, 'zlib' or 'lzma', large encrypted sections are then
+        compressed before AES, see COMPRESS_THRESHOLD.'''
+    if mode not in ('CBC', 'GCM'):
+        raise ValueError(f"Invalid mode '{mode}'")
+    if compress is not None and compress not in COMPRESSION_ALGORITHMS:
+        raise ValueError(f"Unsupported compression '{compress}'")
+    if merkle_section is not None and sections_to_encrypt is None and dst_public_key is not None:
+        raise ValueError("Merkle items cannot be sent in a fully encrypted document")
+    if session is not None:
+        mode = 'GCM'
+    version = _suite_of(src_private_key)
+    recipients = None
+    if isinstance(dst_public_key, (list, tuple)):
+        recipients = list(dst_public_key)
+        if not recipients:
+            raise ValueError("No recipients given")
+        if session is not None or version != SUITE_RSA or any(_suite_of(key) != SUITE_RSA for key in recipients):
+            raise ValueError("Multiple recipients are only supported with RSA keys")
+    elif session is None and dst_public_key is not None and _suite_of(dst_public_key) != version:
+        raise ValueError("Source and destination keys belong to different cipher suites")
+
     # Generate AES key and encrypt contents
-    gen_key = get_random_bytes(32) # 32 for AES-256
-    gen_cipher = AES.new(gen_key, AES.MODE_CBC)
+    if session is not None:
+        gen_key = session.enc_key
+    elif version == SUITE_ED25519 and dst_public_key is not None:
+        gen_key, gen_iv, ephemeral_key = _ecdh_wrap(dst_public_key)
+        gen_cipher = AES.new(gen_key, AES.MODE_CBC, gen_iv)
+    else:
+        gen_key = get_random_bytes(32) # 32 for AES-256
+        gen_cipher = AES.new(gen_key, AES.MODE_CBC)
+
+    compressed_sections = []
+
+    def compress_section(section, json_bytes):
+        if compress is None or len(json_bytes) < COMPRESS_THRESHOLD:
+            return json_bytes
+        with _phase('compress', len(json_bytes)):
+            compressed = _compress(json_bytes, compress)
+        if len(compressed) >= len(json_bytes):
+            return json_bytes
+        compressed_sections.append(section)
+        return compressed
+
+    def encrypt_section(section, json_bytes):
+        json_bytes = compress_section(section, json_bytes)
+        if mode == 'GCM':
+            return _gcm_encrypt(gen_key, json_bytes, section)
+        with _phase('aes', len(json_bytes)):
+            ciphertext = _cbc_encrypt(gen_cipher, json_bytes)
+        with _phase('base64', len(ciphertext)):
+            return _b64encode(ciphertext)
 
     json_mutable = json_object.copy()
 
+    if merkle_section is not None:
+        items = json_mutable.pop(merkle_section)
+        with _phase('sha256', sum(len(item['content']) for item in items)):
+            merkle = { 'section': merkle_section,
+                       'count':   len(items),
+                       'root':    merkle_root([fragment_digest(item) for item in items]).hex(), }
+
     if sections_to_encrypt is None and dst_public_key is not None:
         # -- encrypt entire json --
-        json_bytes = json.dumps(json_mutable).encode('utf-8')
-        ciphertext = gen_cipher.encrypt(pad(json_bytes, AES.block_size))
-        json_mutable = b64encode(ciphertext).decode('utf-8')
+        with _phase('serialize') as timer:
+            json_bytes = json.dumps(json_mutable).encode('utf-8')
+            timer.add_bytes(len(json_bytes))
+        if mode == 'GCM':
+            json_mutable = _gcm_encrypt_chunks(gen_key, compress_section('', json_bytes))
+        else:
+            json_mutable = encrypt_section('', json_bytes)
     elif sections_to_encrypt is not None and len(sections_to_encrypt):
         # -- encrypt only the specified sections --
         for section in sections_to_encrypt:
             # remove the section from the json
             content = json_mutable.get(section, None)
             if content is None:
-                print(f"WARNING: section '{section}' not found in JSON")
+                print(f"WARNING: section '{section}' not found in JSON", file=sys.stderr)
                 continue
 
             # encrypt the section
-            json_bytes = json.dumps(content).encode('utf-8')
-            ciphertext = gen_cipher.encrypt(pad(json_bytes, AES.block_size))
-            encrypted_content = b64encode(ciphertext).decode('utf-8')
+            with _phase('serialize') as timer:
+                json_bytes = json.dumps(content).encode('utf-8')
+                timer.add_bytes(len(json_bytes))
+            encrypted_content = encrypt_section(section, json_bytes)
 
             # replace the section in the json
             json_mutable[section] = encrypted_content
 
-    json_bytes = json.dumps({
+    root_json = {
         'json': json_mutable,
         'timestamp': datetime.utcnow().timestamp(),
         'nonce': get_random_bytes(16).hex(),
         'encrypted_sections': sections_to_encrypt if sections_to_encrypt is not None else [],
         'fully_encrypted': sections_to_encrypt is None and dst_public_key is not None,
-    })
+        'mode': mode,
+    }
+    if merkle_section is not None:
+        root_json['merkle'] = merkle
+    if compressed_sections:
+        root_json['compression'] = { 'algorithm': compress,
+                                     'sections':  compressed_sections, }
+    with _phase('serialize') as timer:
+        json_bytes = json.dumps(root_json)
+        timer.add_bytes(len(json_bytes))
 
-    if dst_public_key is not None:
-        # Encrypt AES key and IV with public RSA key
-        rsa_cipher = PKCS1_v1_5.new(dst_public_key)
-        ciphertext = rsa_cipher.encrypt(gen_key + gen_cipher.iv) # this concatenates the bytes
-        encrypted_key = b64encode(ciphertext).decode('utf-8')
+    if session is not None:
+        # Authenticate contents with the session MAC key
+        with _phase('hmac', len(json_bytes)):
+            mac = HMAC.new(session.mac_key, json_bytes.encode('utf-8'), SHA256).digest()
+        document = { 'content':       json_bytes,
+                     'session':       session.session_id,
+                     'mac':           b64encode(mac).decode('utf-8'), }
 
-    # Create contents digest and sign
-    hashed = SHA256.new(json_bytes.encode('utf-8'))
-    signer = pkcs1_15.new(src_private_key)
-    ciphertext = signer.sign(hashed)
-    encrypted_hash = b64encode(ciphertext).decode('utf-8')
+    elif version == SUITE_ED25519:
+        # Sign contents with Ed25519, AES key was agreed with ECDH
+        with _phase('ed25519_sign', len(json_bytes)):
+            signer = eddsa.new(src_private_key, 'rfc8032')
+            ciphertext = signer.sign(json_bytes.encode('utf-8'))
+        document = { 'version':       SUITE_ED25519,
+                     'content':       json_bytes,
+                     'signature':     b64encode(ciphertext).decode('utf-8'), }
+        if dst_public_key is not None:
+            document['ephemeral_key'] = b64encode(ephemeral_key).decode('utf-8')
 
-    if dst_public_key is None:
-        return { 'content':       json_bytes,
-                 'signature':     encrypted_hash, }
+    else:
+        if dst_public_key is not None:
+            # GCM nonces are per section, only the key is needed
+            key_iv = gen_key if mode == 'GCM' else gen_key + gen_cipher.iv # this concatenates the bytes
 
-    return     { 'content':       json_bytes,
-                 'encrypted_key': encrypted_key,
-                 'signature':     encrypted_hash, }
+            # Encrypt AES key and IV with public RSA key, of every recipient
+            with _phase('rsa_wrap'):
+                if recipients is None:
+                    ciphertext = PKCS1_v1_5.new(dst_public_key).encrypt(key_iv)
+                    encrypted_key = b64encode(ciphertext).decode('utf-8')
+                else:
+                    encrypted_keys = { key_fingerprint(key): b64encode(PKCS1_v1_5.new(key).encrypt(key_iv)).decode('utf-8')
+                                       for key in recipients }
 
-def decrypt_json(encrypted_document, src_public_key, dst_private_key, seen_nonces=None, freshness_check=True):
-    ''' Decrypts encrypted_document using AES, AES key is found by decrypting
-        with dst_private_key, the signature is checked using src_public_key,
-        and the decrypted contents are returned directly.'''
-    content       = encrypted_document.get('content')
-    encrypted_key = encrypted_document.get('encrypted_key')
+        # Create contents digest and sign
+        with _phase('sha256', len(json_bytes)):
+            hashed = SHA256.new(json_bytes.encode('utf-8'))
+        with _phase('rsa_sign'):
+            signer = pkcs1_15.new(src_private_key)
+            ciphertext = signer.sign(hashed)
+        encrypted_hash = b64encode(ciphertext).decode('utf-8')
+
+        if dst_public_key is None:
+            document = { 'content':       json_bytes,
+                         'signature':     encrypted_hash, }
+        elif recipients is not None:
+            document = { 'content':        json_bytes,
+                         'encrypted_keys': encrypted_keys,
+                         'signature':      encrypted_hash, }
+        else:
+            document = { 'content':       json_bytes,
+                         'encrypted_key': encrypted_key,
+                         'signature':     encrypted_hash, }
+
+    if merkle_section is not None:
+        document['items'] = items
+    return document
+
+# -- lazily decrypted documents --
+#
+# decrypt_json(lazy=True) returns a LazyDocument instead of a dict. The
+# signature is still checked up front, but each encrypted section is only
+# decrypted and parsed the first time it is read, so a caller reading one
+# field of a large document pays for that section only. only_sections=[...]
+# goes further and leaves the other encrypted sections out of the result.
+#
+# CBC sections are encrypted one after the other with a single cipher, each
+# one continuing from the last ciphertext block of the one before, which is
+# all that is needed to decrypt them in any order, see _cbc_chain_ivs().
+#
+
+class LazyDocument(Mapping):
+    ''' Read-only mapping of a decrypted document, encrypted sections are
+        decrypted when first read and kept. Use to_dict() for a plain dict,
+        decrypting whatever is left.'''
+    __slots__ = ('_fields', '_pending', '_load')
+
+    def __init__(self, fields, pending, load):
+        self._fields  = fields
+        self._pending = set(pending)
+        self._load    = load if pending else None
+
+    def __getitem__(self, name):
+        value = self._fields[name]
+        if name in self._pending:
+            value = self._load(name, value)
+            self._fields[name] = value
+            self._pending.discard(name)
+            if not self._pending:
+                self._load = None # drops the document key
+        return value
+
+    def __contains__(self, name):
+        return name in self._fields
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __repr__(self):
+        return f"LazyDocument({list(self._fields)}, pending={sorted(self._pending)})"
+
+    @property
+    def pending(self):
+        ''' The sections not decrypted yet.'''
+        return frozenset(self._pending)
+
+    def to_dict(self):
+        return { name: self[name] for name in self._fields }
+
+def _cbc_chain_ivs(iv, json_object, encrypted_sections):
+    ''' Returns the IV of every CBC section, see above. Only the base64 tail
+        holding the last block of each section is decoded.'''
+    ivs = {}
+    for section in encrypted_sections:
+        encrypted_content = json_object.get(section, None)
+        if encrypted_content is None:
+            continue
+        ivs[section] = iv
+        # 24 base64 characters hold at least the last 16 bytes
+        iv = _b64decode(encrypted_content[-24:])[-AES.block_size:]
+    return ivs
+
+def _check_document(encrypted_document, src_public_key, seen_nonces, freshness_check, session, max_size,
+                    verify_cache, require_signature=False):
+    ''' Runs the stages of decrypt_json() that need no private key: size,
+        header, freshness and signature or MAC. Returns the Envelope, or None
+        and the reason; invalid signatures raise ValueError. Without
+        src_public_key a signature is not checked, unless require_signature.'''
+    # -- size --
+    if _document_size(encrypted_document) > max_size:
+        _count_rejection('size')
+        return None, "document is too large"
+
+    # -- header --
+    try:
+        with _phase('parse', _document_size(encrypted_document)):
+            envelope = _as_envelope(encrypted_document)
+    except (ValueError, TypeError, AttributeError):
+        _count_rejection('header')
+        return None, "document header is malformed"
+
+    version = envelope.version
+    if version not in (SUITE_RSA, SUITE_ED25519):
+        _count_rejection('header')
+        return None, f"unsupported document version '{version}'"
     if seen_nonces is None:
         seen_nonces = set()
 
-    root_json = json.loads(content)
+    # -- freshness --
+    root_json = envelope.root_json
     if freshness_check:
         if root_json['nonce'] in seen_nonces:
+            _count_rejection('freshness')
             return None, "freshness check failed, nonce has been seen before"
 
-        now = datetime.utcnow().timestamp() - 60 # 60 second leeway
-        if root_json['timestamp'] < now:
+        now = datetime.utcnow().timestamp()
+        if root_json['timestamp'] < now - FRESHNESS_WINDOW:
+            _count_rejection('freshness')
             return None, "freshness check failed, timestamp is too old"
+        if root_json['timestamp'] > now + FRESHNESS_WINDOW:
+            _count_rejection('freshness')
+            return None, "freshness check failed, timestamp is in the future"
 
-    if encrypted_key is not None:
-        # Decrypt AES key and IV with private RSA key
-        sentinel = get_random_bytes(32 + 16)
-        rsa_cipher = PKCS1_v1_5.new(dst_private_key)
-        ciphertext = b64decode(encrypted_key.encode())
-        gen_key_iv = rsa_cipher.decrypt(ciphertext, sentinel, expected_pt_len=32 + 16)
-        assert gen_key_iv != sentinel
+    # -- signature, public key or MAC only --
+    try:
+        if 'mac' in envelope:
+            # This will raise an exception if the MAC is invalid
+            test_json_mac(envelope, session)
+        elif 'session' in envelope or (session is not None and src_public_key is None):
+            # a session document is only ever authenticated by its MAC
+            raise ValueError("Session document carries no MAC")
+        elif src_public_key is not None and verify_cache is not None:
+            # This will raise an exception if the signature is invalid
+            verify_cache.verify(envelope, src_public_key)
+        elif src_public_key is not None:
+            # This will raise an exception if the signature is invalid
+            test_json_hash(envelope, src_public_key)
+        elif require_signature:
+            _count_rejection('signature')
+            return None, "no public key to check the signature with"
+    except ValueError:
+        _count_rejection('signature')
+        raise
 
-        gen_key = gen_key_iv[:32]
-        gen_iv  = gen_key_iv[32:32+16]
-        gen_cipher = AES.new(gen_key, AES.MODE_CBC, gen_iv)
+    return envelope, None
 
-    if root_json['fully_encrypted']:
-        # -- decrypt entire json --
-        decoded_content = b64decode(root_json['json'].encode('utf-8'))
-        raw_content = unpad(gen_cipher.decrypt(decoded_content), AES.block_size)
-        json_mutable = json.loads(raw_content)
-    else:
-        # -- decrypt only the specified sections --
-        json_mutable = root_json['json']
-        for section in root_json['encrypted_sections']:
-            # remove the section from the json
-            decoded_content = json_mutable.get(section, None)
-            if decoded_content is None:
-                print(f"WARNING: section '{section}' not found in JSON")
-                continue
-            decoded_content = b64decode(decoded_content.encode('utf-8'))
+def check_json(encrypted_document, src_public_key, seen_nonces=None, freshness_check=True, session=None,
+               max_size=MAX_DOCUMENT_SIZE, verify_cache=None):
+    ''' Checks encrypted_document like decrypt_json() does, size, header,
+        freshness and signature or MAC, without decrypting anything or
+        touching a private key. Nothing is recorded in seen_nonces.
+        
+        Signed documents need src_public_key and session documents need
+        session, a document that cannot be checked is invalid.
+        
+        Returns True and the nonce if the document is valid, else None and
+        the reason. Invalid signatures raise ValueError.'''
+    envelope, error = _check_document(encrypted_document, src_public_key, seen_nonces, freshness_check, session,
+                                      max_size, verify_cache, require_signature=True)
+    if envelope is None:
+        return None, error
+    return True, envelope.nonce
+
+def decrypt_json(encrypted_document, src_public_key, dst_private_key, seen_nonces=None, freshness_check=True, session=None,
+                 max_size=MAX_DOCUMENT_SIZE, verify_cache=None, lazy=False, only_sections=None,
+                 max_decompressed_size=MAX_DECOMPRESSED_SIZE):
+    ''' Decrypts encrypted_document using AES, AES key is found by decrypting
+        with dst_private_key, the signature is checked using src_public_key,
+        and the decrypted contents are returned directly.
+        
+        encrypted_document may also be an Envelope, or in the binary format
+        of pack_document().
+        
+        Documents carrying a MAC instead of a signature are checked and
+        decrypted with session, signed documents ignore it. A document naming
+        a session, or decrypted with session and no src_public_key, must
+        carry a MAC that verifies.
+        
+        With verify_cache, a VerifyCache, signatures verified before are not
+        verified again.
+        
+        seen_nonces may be a set, which the caller updates, or a ReplayCache,
+        where the nonce is recorded once the signature has been checked.
+        
+        With lazy, a LazyDocument is returned and encrypted sections are only
+        decrypted when read, raising ValueError then if they are corrupt.
+        With only_sections, a list of section names, the other encrypted
+        sections are not decrypted and left out of the result.
+        
+        Compressed sections are decompressed, one inflating to more than
+        max_decompressed_size bytes raises ValueError.
+        
+        Checks run cheapest first, see REJECTION_STAGES, so forged or replayed
+        documents are rejected before any private key operation. Size, header
+        and freshness failures return None and the reason, invalid signatures
+        and ciphertexts raise ValueError.'''
+    envelope, error = _check_document(encrypted_document, src_public_key, seen_nonces, freshness_check, session,
+                                      max_size, verify_cache)
+    if envelope is None:
+        return None, error
 
-            # decrypt the section
-            raw_content = unpad(gen_cipher.decrypt(decoded_content), AES.block_size)
+    encrypted_key  = envelope.get('encrypted_key')
+    ephemeral_key  = envelope.get('ephemeral_key')
+    encrypted_keys = envelope.get('encrypted_keys')
+    version        = envelope.version
+    is_session     = 'mac' in envelope
+    root_json      = envelope.root_json
 
-            # replace the section in the json
-            json_mutable[section] = json.loads(raw_content)
+    # -- record the nonce, now that the document is authentic --
+    if freshness_check and hasattr(seen_nonces, 'check_and_add'):
+        if not seen_nonces.check_and_add(root_json['nonce'], root_json['timestamp']):
+            _count_rejection('freshness')
+            return None, "freshness check failed, nonce has been seen before"
+
+    # -- unwrap, the only private key operation --
+    mode = envelope.mode
+    gen_key = gen_iv = None # stay None for signed-only documents
+    try:
+        if encrypted_keys is not None and not is_session:
+            # Multi-recipient document, pick the entry of our own key
+            if dst_private_key is None:
+                raise ValueError("Document is encrypted but no private key was given")
+            encrypted_key = encrypted_keys.get(key_fingerprint(dst_private_key))
+            if encrypted_key is None:
+                raise ValueError("Document is not addressed to this key")
+
+        if is_session:
+            gen_key = session.enc_key
+        elif encrypted_key is not None:
+            # Decrypt AES key and IV with private RSA key
+            key_iv_len = 32 if mode == 'GCM' else 32 + 16
+            sentinel = get_random_bytes(key_iv_len)
+            with _phase('rsa_unwrap'):
+                rsa_cipher = PKCS1_v1_5.new(dst_private_key)
+                ciphertext = b64decode(encrypted_key.encode())
+                gen_key_iv = rsa_cipher.decrypt(ciphertext, sentinel, expected_pt_len=key_iv_len)
+            if gen_key_iv == sentinel:
+                raise ValueError("Could not decrypt the document key")
+
+            gen_key = gen_key_iv[:32]
+            gen_iv  = gen_key_iv[32:32+16]
+        elif version == SUITE_ED25519 and ephemeral_key is not None:
+            # Derive AES key and IV with ECDH against the ephemeral key
+            gen_key, gen_iv = _ecdh_unwrap(dst_private_key, b64decode(ephemeral_key.encode()))
+
+        if gen_key is None and (root_json['fully_encrypted'] or root_json['encrypted_sections']):
+            raise ValueError("Document is encrypted but carries no key")
+    except ValueError:
+        _count_rejection('unwrap')
+        raise
+
+    def decrypt_section(section, encrypted_content):
+        if mode == 'GCM':
+            return _gcm_decrypt(gen_key, encrypted_content, section)
+        with _phase('base64', len(encrypted_content)):
+            decoded_content = _b64decode(encrypted_content)
+        with _phase('aes', len(decoded_content)):
+            return _cbc_decrypt(AES.new(gen_key, AES.MODE_CBC, section_ivs.get(section, gen_iv)), decoded_content)
+
+    compression = envelope.compression
+    compressed_sections = compression['sections'] if compression is not None else ()
+
+    def decompress_section(section, raw_content):
+        if section not in compressed_sections:
+            return raw_content
+        with _phase('decompress', len(raw_content)):
+            return _decompress(raw_content, compression['algorithm'], max_decompressed_size)
 
-    if src_public_key is not None:
-        # This will raise an exception if the signature is invalid
-        test_json_hash(encrypted_document, src_public_key)
+    def load_section(section, encrypted_content):
+        raw_content = decompress_section(section, decrypt_section(section, encrypted_content))
+        with _phase('parse', len(raw_content)):
+            return json.loads(raw_content)
 
+    def load_lazily(section, encrypted_content):
+        try:
+            return load_section(section, encrypted_content)
+        except ValueError:
+            _count_rejection('decrypt')
+            raise
+
+    # -- decrypt --
+    section_ivs = {}
+    try:
+        if root_json['fully_encrypted']:
+            # -- decrypt entire json --
+            if mode == 'GCM':
+                raw_content = _gcm_decrypt_chunks(gen_key, root_json['json'])
+            else:
+                raw_content = decrypt_section('', root_json['json'])
+            raw_content = decompress_section('', raw_content)
+            with _phase('parse', len(raw_content)):
+                json_mutable = json.loads(raw_content)
+            if only_sections is not None:
+                json_mutable = { section: value for section, value in json_mutable.items()
+                                 if section in only_sections }
+            pending = ()
+        else:
+            # -- decrypt only the specified sections --
+            json_mutable = root_json['json'].copy() # envelope stays untouched
+            if mode == 'CBC' and gen_iv is not None and root_json['encrypted_sections']:
+                section_ivs = _cbc_chain_ivs(gen_iv, json_mutable, root_json['encrypted_sections'])
+            pending = []
+            for section in root_json['encrypted_sections']:
+                # remove the section from the json
+                encrypted_content = json_mutable.get(section, None)
+                if encrypted_content is None:
+                    print(f"WARNING: section '{section}' not found in JSON", file=sys.stderr)
+                    continue
+                if only_sections is not None and section not in only_sections:
+                    del json_mutable[section]
+                    continue
+                if lazy:
+                    pending.append(section)
+                    continue
+
+                # decrypt the section and replace it in the json
+                json_mutable[section] = load_section(section, encrypted_content)
+
+        merkle = envelope.merkle
+        if merkle is not None:
+            # -- put the Merkle items back, checked with the signature --
+            items = envelope.get('items')
+            with _phase('parse', sum(len(item['content']) for item in items)):
+                json_mutable[merkle['section']] = [json.loads(item['content']) for item in items]
+    except ValueError:
+        _count_rejection('decrypt')
+        raise
+
+    if lazy:
+        json_mutable = LazyDocument(json_mutable, pending, load_lazily)
     return json_mutable, root_json['nonce']
 
 def test_json_hash(encrypted_document, src_public_key):
-    ''' Tests the hash/signature of a JSON object. Ignores freshness.'''
-    content = encrypted_document.get('content')
-    signature = encrypted_document.get('signature')
+    ''' Tests the hash/signature of a JSON object, and its Merkle items if
+        any. Ignores freshness.'''
+    envelope = _as_envelope(encrypted_document)
+    signature = envelope.get('signature')
+    if not isinstance(signature, str):
+        raise ValueError("Document has no signature")
+
+    if envelope.version == SUITE_ED25519:
+        # Ed25519 signs the content directly
+        with _phase('ed25519_verify', len(envelope.content)):
+            verifier = eddsa.new(src_public_key, 'rfc8032')
+            verifier.verify(envelope.content_bytes, b64decode(signature.encode()))
+        test_merkle_items(envelope)
+        return
 
     # Test raw_content with the signed digest
-    hashed = SHA256.new(content.encode('utf-8'))
-    signer = pkcs1_15.new(src_public_key)
-    signature = b64decode(signature.encode())
-    signer.verify(hashed, signature)
+    with _phase('sha256', len(envelope.content)):
+        hashed = envelope.digest
+    with _phase('rsa_verify'):
+        signer = pkcs1_15.new(src_public_key)
+        signature = b64decode(signature.encode())
+        signer.verify(hashed, signature)
+    test_merkle_items(envelope)
+
+def test_json_mac(encrypted_document, session):
+    ''' Tests the MAC of a session JSON object. Ignores freshness.'''
+    if session is None:
+        raise ValueError("Document belongs to a session but no session was given")
+    envelope = _as_envelope(encrypted_document)
+    if envelope.session != session.session_id:
+        raise ValueError("Document belongs to a different session")
+
+    mac = b64decode(envelope.get('mac').encode())
+
+    # This will raise ValueError if the MAC does not match
+    with _phase('hmac', len(envelope.content)):
+        hmac = HMAC.new(session.mac_key, envelope.content_bytes, SHA256)
+        hmac.verify(mac)
+    test_merkle_items(envelope)
+
+
+# -- binary envelope format --
+#
+# Alternative wire format for documents, negotiated with BINARY_CONTENT_TYPE.
+# Instead of a JSON string inside a JSON object with base64 values, it is
+#
+#     b'BA' + format version (u8) + flags (u8) + field count (u8)
+#     + fields, each one tag (u8) + length (u32, big endian) + raw bytes
+#
+# Signatures, keys and every encrypted section or chunk are carried as raw
+# bytes. The content field holds the content JSON with encrypted values
+# replaced by null, the blob fields that follow put them back in order.
+# Signatures cover the original content string, so unpack_document() rebuilds
+# it exactly; if that would not reproduce it, pack_document() stores the
+# content verbatim instead (FLAG_VERBATIM). Merkle items, if any, follow
+# as a single TAG_ITEMS field holding the JSON list of fragments, and the
+# keys of a multi-recipient document as a single TAG_RECIPIENTS field.
+#
+
+BINARY_CONTENT_TYPE = 'application/vnd.bombappetit+binary'
+BINARY_MAGIC        = b'BA'
+BINARY_VERSION      = 1
+
+FLAG_VERBATIM = 0x01
+
+TAG_CONTENT       = 1
+TAG_SIGNATURE     = 2
+TAG_ENCRYPTED_KEY = 3
+TAG_EPHEMERAL_KEY = 4
+TAG_MAC           = 5
+TAG_SESSION       = 6
+TAG_VERSION       = 7
+TAG_SECTION       = 8  # section name length (u16) + name + ciphertext
+TAG_CHUNK         = 9  # one chunk of a fully encrypted GCM json
+TAG_FULL          = 10 # fully encrypted CBC json
+TAG_ITEMS         = 11 # fragments of a Merkle document
+TAG_RECIPIENTS    = 12 # per recipient, fingerprint (32) + length (u16) + wrapped key
+
+_B64_FIELDS = { 'signature':     TAG_SIGNATURE,
+                'encrypted_key': TAG_ENCRYPTED_KEY,
+                'ephemeral_key': TAG_EPHEMERAL_KEY,
+                'mac':           TAG_MAC, }
+
+def _extract_blobs(root_json):
+    ''' Replaces encrypted values of root_json with None, returns them as
+        (tag, raw bytes) fields.'''
+    blobs = []
+    if root_json.get('fully_encrypted'):
+        if isinstance(root_json['json'], list):
+            blobs = [(TAG_CHUNK, b64decode(chunk)) for chunk in root_json['json']]
+        else:
+            blobs = [(TAG_FULL, b64decode(root_json['json']))]
+        root_json['json'] = None
+        return blobs
+
+    for section in root_json.get('encrypted_sections', []):
+        value = root_json['json'].get(section)
+        if not isinstance(value, str):
+            continue
+        name = section.encode('utf-8')
+        blobs.append((TAG_SECTION, struct.pack('>H', len(name)) + name + b64decode(value)))
+        root_json['json'][section] = None
+    return blobs
+
+def _insert_blobs(root_json, blobs):
+    ''' Reverses _extract_blobs(), raises ValueError if a blob does not fit
+        root_json.'''
+    if not isinstance(root_json, dict):
+        raise ValueError("Malformed binary document content")
+    chunks = []
+    for tag, raw in blobs:
+        if tag == TAG_SECTION:
+            if len(raw) < 2:
+                raise ValueError("Truncated binary document section")
+            name_len = struct.unpack('>H', raw[:2])[0]
+            if 2 + name_len > len(raw):
+                raise ValueError("Truncated binary document section")
+            if not isinstance(root_json.get('json'), dict):
+                raise ValueError("Binary document section without a JSON object")
+            section  = bytes(raw[2:2 + name_len]).decode('utf-8')
+            root_json['json'][section] = b64encode(raw[2 + name_len:]).decode('utf-8')
+        elif tag == TAG_CHUNK:
+            chunks.append(b64encode(raw).decode('utf-8'))
+        elif tag == TAG_FULL:
+            root_json['json'] = b64encode(raw).decode('utf-8')
+    if chunks:
+        root_json['json'] = chunks
+
+def pack_document(encrypted_document):
+    ''' Converts the output of encrypt_json() to the binary format.'''
+    content = encrypted_document['content']
+    flags   = 0
+
+    root_json = json.loads(content)
+    blobs = _extract_blobs(root_json)
+    header = json.dumps(root_json)
+    rebuilt = json.loads(header)
+    _insert_blobs(rebuilt, blobs)
+    if json.dumps(rebuilt) != content:
+        flags |= FLAG_VERBATIM
+        header, blobs = content, []
+
+    fields = [(TAG_CONTENT, header.encode('utf-8'))]
+    for name, tag in _B64_FIELDS.items():
+        if name in encrypted_document:
+            fields.append((tag, b64decode(encrypted_document[name])))
+    if 'session' in encrypted_document:
+        fields.append((TAG_SESSION, encrypted_document['session'].encode('utf-8')))
+    if 'version' in encrypted_document:
+        fields.append((TAG_VERSION, bytes([encrypted_document['version']])))
+    fields += blobs
+    if 'items' in encrypted_document:
+        fields.append((TAG_ITEMS, json.dumps(encrypted_document['items']).encode('utf-8')))
+    if 'encrypted_keys' in encrypted_document:
+        recipients = []
+        for fingerprint, wrapped in encrypted_document['encrypted_keys'].items():
+            wrapped = b64decode(wrapped)
+            recipients.append(bytes.fromhex(fingerprint) + struct.pack('>H', len(wrapped)) + wrapped)
+        fields.append((TAG_RECIPIENTS, b''.join(recipients)))
+
+    if len(fields) > 255:
+        raise ValueError("Too many encrypted sections for the binary format")
+
+    packed = [BINARY_MAGIC, bytes([BINARY_VERSION, flags, len(fields)])]
+    for tag, raw in fields:
+        packed.append(struct.pack('>BI', tag, len(raw)))
+        packed.append(raw)
+    return b''.join(packed)
+
+def unpack_document(data):
+    ''' Converts a document in the binary format back to the dict form
+        accepted by decrypt_json(). Raises ValueError if malformed.'''
+    data = memoryview(data)
+    if len(data) < 5 or bytes(data[:2]) != BINARY_MAGIC or data[2] != BINARY_VERSION:
+        raise ValueError("Not a binary BombAppetit document")
+    flags, count = data[3], data[4]
+
+    fields = []
+    offset = 5
+    for _ in range(count):
+        if offset + 5 > len(data):
+            raise ValueError("Truncated binary document")
+        tag, length = struct.unpack_from('>BI', data, offset)
+        offset += 5
+        if offset + length > len(data):
+            raise ValueError("Truncated binary document")
+        fields.append((tag, data[offset:offset + length]))
+        offset += length
+
+    encrypted_document = {}
+    header = None
+    blobs = []
+    tags_to_names = { tag: name for name, tag in _B64_FIELDS.items() }
+    for tag, raw in fields:
+        if tag == TAG_CONTENT:
+            header = bytes(raw).decode('utf-8')
+        elif tag in tags_to_names:
+            encrypted_document[tags_to_names[tag]] = b64encode(raw).decode('utf-8')
+        elif tag == TAG_SESSION:
+            encrypted_document['session'] = bytes(raw).decode('utf-8')
+        elif tag == TAG_VERSION:
+            if len(raw) != 1:
+                raise ValueError("Malformed binary document version")
+            encrypted_document['version'] = raw[0]
+        elif tag == TAG_ITEMS:
+            encrypted_document['items'] = json.loads(bytes(raw))
+        elif tag == TAG_RECIPIENTS:
+            encrypted_keys = {}
+            position = 0
+            while position < len(raw):
+                if position + 34 > len(raw):
+                    raise ValueError("Truncated binary document")
+                fingerprint = bytes(raw[position:position + 32]).hex()
+                length = struct.unpack_from('>H', raw, position + 32)[0]
+                position += 34
+                if position + length > len(raw):
+                    raise ValueError("Truncated binary document")
+                encrypted_keys[fingerprint] = b64encode(raw[position:position + length]).decode('utf-8')
+                position += length
+            encrypted_document['encrypted_keys'] = encrypted_keys
+        else:
+            blobs.append((tag, raw))
+
+    if header is None:
+        raise ValueError("Binary document has no content")
+    if flags & FLAG_VERBATIM:
+        encrypted_document['content'] = header
+    else:
+        root_json = json.loads(header)
+        _insert_blobs(root_json, blobs)
+        encrypted_document['content'] = json.dumps(root_json)
+    return encrypted_document
 
 
 def create_keypair(key_size=2048):
     ''' Generates a new RSA keypair and returns it as a tuple of public and
         private keys.'''
-    private_key = RSA.generate(key_size)
+    private_key = _generate_rsa(key_size)
     public_key  = private_key.publickey()
 
     return private_key, public_key
 
+def create_ed25519_keypair():
+    ''' Generates a new Ed25519 keypair, for the version 2 suite, and returns
+        it as a tuple of public and private keys.'''
+    private_key = ECC.generate(curve='ed25519')
+    public_key  = private_key.public_key()
+
+    return private_key, public_key
+
 def load_keypair(filename):
-    ''' Loads a keypair from a file and returns it as a tuple of public and
-        private keys.'''
+    ''' Loads a keypair, RSA or Ed25519, from a file and returns it as a
+        tuple of public and private keys.'''
     try:
         with open(filename, 'r') as f:
-            key = RSA.import_key(f.read())
+            key = _import_key(f.read())
         
         if key.has_private():
-            return key, key.publickey()
+            return key, key.public_key()
         else:
             return None, key
     except FileNotFoundError:
@@ -226,9 +1448,101 @@ def load_keypair(filename):
 
 def save_key(filename, key):
     ''' Saves a key to a file.'''
+    exported = key.export_key(format='PEM')
+    if isinstance(exported, bytes):
+        # RSA keys export to bytes, ECC keys to str
+        exported = exported.decode('utf-8')
+
     with open(filename, 'w') as f:
-        f.write(key.export_key().decode('utf-8'))
+        f.write(exported)
+
+def _import_key(key_str):
+    ''' Imports a PEM encoded RSA or Ed25519 key.'''
+    try:
+        return RSA.import_key(key_str)
+    except ValueError:
+        return ECC.import_key(key_str)
+
+
+
+# -- parsed key cache --
+#
+# Server and client convert the same handful of PEM strings to key objects on
+# every request, so str_to_key() goes through a bounded LRU cache keyed by the
+# SHA256 digest of the PEM encoding instead of re-parsing each time.
+#
+
+class KeyCache:
+    ''' Thread-safe LRU cache of parsed keys, keyed by the digest of their
+        PEM encoding. Keeps at most maxsize keys and counts hits and misses.'''
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits    = 0
+        self.misses  = 0
+        self._keys   = OrderedDict()
+        self._lock   = threading.Lock()
+
+    def get(self, key_str):
+        ''' Returns the parsed key for key_str (str or bytes), importing it
+            on a miss.'''
+        if isinstance(key_str, str):
+            key_str = key_str.encode('utf-8')
+        digest = hashlib.sha256(key_str).digest()
+
+        with self._lock:
+            key = self._keys.get(digest)
+            if key is not None:
+                self._keys.move_to_end(digest)
+                self.hits += 1
+                return key
+            self.misses += 1
+
+        # import outside the lock, parsing is the slow part
+        key = _import_key(key_str)
+
+        with self._lock:
+            self._keys[digest] = key
+            self._keys.move_to_end(digest)
+            while len(self._keys) > self.maxsize:
+                self._keys.popitem(last=False)
+        return key
+
+    def clear(self):
+        ''' Removes every cached key and resets the counters.'''
+        with self._lock:
+            self._keys.clear()
+            self.hits   = 0
+            self.misses = 0
+
+    def stats(self):
+        ''' Returns a dict with the hit/miss counters and current size.'''
+        with self._lock:
+            return { 'hits':    self.hits,
+                     'misses':  self.misses,
+                     'size':    len(self._keys),
+                     'maxsize': self.maxsize, }
+
+    def __len__(self):
+        return len(self._keys)
+
+key_cache = KeyCache()
 
 def str_to_key(key_str):
-    ''' Converts a string to a public key.'''
-    return RSA.import_key(key_str)
+    ''' Converts a string to a public key. Parsed keys are cached in
+        key_cache, so repeated calls with the same PEM are cheap.'''
+    return key_cache.get(key_str)
+
+# id(key) -> (weak reference to key, fingerprint), keys are not hashable
+_fingerprints = {}
+
+def key_fingerprint(key):
+    ''' Returns the SHA256 hex digest of the DER encoded public key, the
+        same for a private key and its public key. Memoized per key object.'''
+    entry = _fingerprints.get(id(key))
+    if entry is not None and entry[0]() is key:
+        return entry[1]
+
+    fingerprint = hashlib.sha256(key.public_key().export_key(format='DER')).hexdigest()
+    key_id = id(key)
+    _fingerprints[key_id] = (weakref.ref(key, lambda _: _fingerprints.pop(key_id, None)), fingerprint)
+    return fingerprint
@@ -0,0 +1,122 @@
+
+import time
+from contextvars import ContextVar
+
+
+# -- per-phase instrumentation --
+#
+# encrypt_json() and decrypt_json() wrap each of their phases (serialize,
+# parse, aes, base64, sha256, rsa_sign, rsa_verify, rsa_wrap, rsa_unwrap,
+# ed25519_sign, ed25519_verify, ecdh, hmac) in phase(). While a PhaseStats is
+# active in the current context, every phase records its duration and byte
+# count in it:
+#
+#     with BA.PhaseStats() as stats:
+#         BA.decrypt_json(...)
+#     print(stats.report())
+#
+# PhaseStats lives in a ContextVar, so threads and asyncio tasks each see
+# their own. When none is active phase() returns a shared no-op object, the
+# cost is one ContextVar lookup per phase.
+#
+
+_active_stats = ContextVar('BombAppetit_phase_stats', default=None)
+
+class _NullPhase:
+    ''' Phase used when instrumentation is off, does nothing.'''
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def add_bytes(self, nbytes):
+        pass
+
+_NULL_PHASE = _NullPhase()
+
+class _Phase:
+    ''' Times one phase and records it in stats on exit.'''
+    __slots__ = ('stats', 'name', 'nbytes', 'start')
+
+    def __init__(self, stats, name, nbytes):
+        self.stats  = stats
+        self.name   = name
+        self.nbytes = nbytes
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.stats.record(self.name, time.perf_counter() - self.start, self.nbytes)
+        return False
+
+    def add_bytes(self, nbytes):
+        ''' Counts bytes only known once the phase ran, e.g. output sizes.'''
+        self.nbytes += nbytes
+
+def phase(name, nbytes=0):
+    ''' Returns a context manager timing phase name, if instrumentation is
+        active in the current context.'''
+    stats = _active_stats.get()
+    if stats is None:
+        return _NULL_PHASE
+    return _Phase(stats, name, nbytes)
+
+class PhaseStats:
+    ''' Collects per-phase durations and byte counts while active. Can be
+        used as a context manager, or through start()/stop().
+
+        callback, if given, is called as callback(phase, seconds, nbytes)
+        for every recorded phase, e.g. to forward them to a logger.'''
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.phases   = {}
+        self._token   = None
+
+    def record(self, name, seconds, nbytes=0):
+        entry = self.phases.get(name)
+        if entry is None:
+            entry = self.phases[name] = { 'calls': 0, 'seconds': 0.0, 'bytes': 0 }
+        entry['calls']   += 1
+        entry['seconds'] += seconds
+        entry['bytes']   += nbytes
+        if self.callback is not None:
+            self.callback(name, seconds, nbytes)
+
+    def start(self):
+        ''' Makes these stats active in the current context.'''
+        self._token = _active_stats.set(self)
+        return self
+
+    def stop(self):
+        ''' Restores whatever stats were active before start().'''
+        if self._token is not None:
+            _active_stats.reset(self._token)
+            self._token = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+    def as_dict(self):
+        ''' Returns a copy of the collected phases.'''
+        return { name: dict(entry) for name, entry in self.phases.items() }
+
+    def total_seconds(self):
+        return sum(entry['seconds'] for entry in self.phases.values())
+
+    def report(self):
+        ''' Returns the collected phases as a table, slowest first.'''
+        total = self.total_seconds() or 1.0
+        lines = [f"{'phase':16} {'calls':>7} {'ms':>10} {'share':>7} {'bytes':>12}"]
+        for name, entry in sorted(self.phases.items(), key=lambda item: -item[1]['seconds']):
+            lines.append(f"{name:16} {entry['calls']:7} {1000 * entry['seconds']:10.3f}"
+                         f" {entry['seconds'] / total:7.1%} {entry['bytes']:12}")
+        return '\n'.join(lines)
@@ -0,0 +1,152 @@
+
+import os
+import json
+import threading
+from collections import deque
+
+from Crypto.Cipher       import AES
+from Crypto.Protocol.KDF import scrypt
+from Crypto.PublicKey    import RSA
+from Crypto.Random       import get_random_bytes
+
+
+# -- pre-generated keypair pool --
+#
+# RSA generation takes from hundreds of milliseconds (2048 bits) to seconds
+# (4096 bits). A KeyPool keeps target keys of each size ready and refills
+# itself from a background thread, so take() returns at once. Once installed
+# with set_key_pool(), create_keypair() and create_key_pair() take their keys
+# from it.
+#
+# With stash_path the ready keys are also kept on disk, encrypted with
+# AES-GCM under a key derived from stash_password with scrypt, so they
+# survive restarts. The stash is
+#
+#     salt (16 bytes) + nonce (12 bytes) + ciphertext + tag (16 bytes)
+#
+# of a JSON object mapping each key size to a list of PEM private keys. The
+# salt, and so the scrypt work, is reused for the life of the pool. Taken keys
+# are removed from the stash before they are handed out.
+#
+
+class KeyPool:
+    ''' Pool of pre-generated RSA keypairs refilled in the background.'''
+    def __init__(self, sizes=(2048,), target=4, stash_path=None, stash_password=None):
+        if stash_path is not None and stash_password is None:
+            raise ValueError("An encrypted stash needs a password")
+        self.sizes  = tuple(sizes)
+        self.target = target
+        self.stash_path     = stash_path
+        self.stash_password = stash_password
+
+        self._keys    = { size: deque() for size in self.sizes }
+        self._cond    = threading.Condition()
+        self._thread  = None
+        self._running = False
+        self._stash_salt = None
+        self._stash_key  = None
+
+        if stash_path is not None:
+            self._load_stash()
+
+    def start(self):
+        ''' Starts the background refill thread.'''
+        with self._cond:
+            if self._running:
+                return self
+            self._running = True
+        self._thread = threading.Thread(target=self._refill_loop, name='BombAppetit-KeyPool', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        ''' Stops the background refill thread, ready keys are kept.'''
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def take(self, key_size):
+        ''' Returns a (private, public) keypair of key_size bits, from the
+            pool if one is ready, else generated inline.'''
+        with self._cond:
+            keys = self._keys.get(key_size)
+            key = keys.popleft() if keys else None
+            if key is not None:
+                self._save_stash()
+            # wake the refill thread either way
+            self._cond.notify_all()
+
+        if key is None:
+            key = RSA.generate(key_size)
+        return key, key.publickey()
+
+    def available(self, key_size):
+        ''' Returns how many keys of key_size are ready.'''
+        with self._cond:
+            return len(self._keys.get(key_size, ()))
+
+    def _missing_size(self):
+        ''' Returns a size below target, or None when the pool is full.'''
+        for size in self.sizes:
+            if len(self._keys[size]) < self.target:
+                return size
+        return None
+
+    def _refill_loop(self):
+        while True:
+            with self._cond:
+                while self._running and self._missing_size() is None:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                size = self._missing_size()
+
+            # generate outside the lock, take() must not wait for it
+            key = RSA.generate(size)
+
+            with self._cond:
+                self._keys[size].append(key)
+                self._save_stash()
+
+    # -- encrypted stash --
+
+    def _derive_stash_key(self, salt):
+        self._stash_salt = salt
+        self._stash_key  = scrypt(self.stash_password, salt, 32, N=2**14, r=8, p=1)
+
+    def _load_stash(self):
+        try:
+            with open(self.stash_path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            self._derive_stash_key(get_random_bytes(16))
+            return
+
+        salt, nonce = data[:16], data[16:16 + 12]
+        self._derive_stash_key(salt)
+        cipher = AES.new(self._stash_key, AES.MODE_GCM, nonce=nonce)
+        # raises ValueError on a wrong password or a tampered stash
+        stash = json.loads(cipher.decrypt_and_verify(data[16 + 12:-16], data[-16:]))
+
+        for size, pems in stash.items():
+            if int(size) in self._keys:
+                self._keys[int(size)].extend(RSA.import_key(pem) for pem in pems)
+
+    def _save_stash(self):
+        ''' Writes the ready keys to the stash, caller holds the lock.'''
+        if self.stash_path is None:
+            return
+
+        stash = { size: [key.export_key().decode('utf-8') for key in keys]
+                  for size, keys in self._keys.items() }
+        cipher = AES.new(self._stash_key, AES.MODE_GCM, nonce=get_random_bytes(12))
+        ciphertext, tag = cipher.encrypt_and_digest(json.dumps(stash).encode('utf-8'))
+
+        # write then rename, so a crash never leaves half a stash
+        temp_path = self.stash_path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(self._stash_salt + cipher.nonce + ciphertext + tag)
+        os.replace(temp_path, self.stash_path)
@@ -0,0 +1,407 @@
+
+import os
+import mmap
+import struct
+import sqlite3
+import hashlib
+import threading
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError: # not on Windows, only SharedMemoryReplayStore needs it
+    fcntl = None
+
+from .functions import FRESHNESS_WINDOW
+
+
+# -- replay cache --
+#
+# A nonce only has to be remembered while its document would still pass the
+# freshness check, FRESHNESS_WINDOW seconds after its timestamp. ReplayCache
+# keeps a ring of per-second buckets covering that window, indexed by the
+# document timestamp, plus a dict from nonce to its second:
+#
+#     lookup and insert    one dict operation
+#     expiry               buckets are emptied as their second leaves the
+#                          window, each nonce is removed once, O(1) amortized
+#
+# Passed as seen_nonces, decrypt_json() checks the nonce in the freshness
+# stage and records it with check_and_add() once the signature is valid, so
+# forged documents never fill the cache.
+#
+# With max_entries, when the cache is full the oldest second is dropped and
+# documents with a timestamp at or before it are rejected from then on, so
+# memory is bounded without letting replays of dropped nonces through.
+#
+
+def _now():
+    ''' Same clock as the document timestamps of encrypt_json().'''
+    return datetime.utcnow().timestamp()
+
+class ReplayCache:
+    ''' In-memory replay cache, see above.'''
+    def __init__(self, window=FRESHNESS_WINDOW, max_entries=None, clock=_now):
+        self.window      = window
+        self.max_entries = max_entries
+        self.clock       = clock
+
+        # documents up to window seconds old or ahead are accepted
+        self._size    = 2 * window + 2
+        self._seconds = [None] * self._size
+        self._buckets = [[] for _ in range(self._size)]
+        self._nonces  = {}
+        self._floor   = None # seconds up to this one were dropped
+        self._horizon = None # seconds up to this one were expired
+        self._lock    = threading.Lock()
+
+        self.inserted = 0
+        self.replays  = 0
+        self.rejected = 0 # outside the window or dropped
+        self.dropped  = 0
+
+    def __contains__(self, nonce):
+        with self._lock:
+            second = self._nonces.get(nonce)
+            return second is not None and second >= int(self.clock()) - self.window - 1
+
+    def __len__(self):
+        return len(self._nonces)
+
+    def _empty(self, index):
+        ''' Forgets the nonces in the bucket at index.'''
+        for nonce in self._buckets[index]:
+            if self._nonces.get(nonce) == self._seconds[index]:
+                del self._nonces[nonce]
+        self._buckets[index] = []
+        self._seconds[index] = None
+
+    def _advance(self, now):
+        ''' Empties the buckets of every second that left the window since
+            the last call, at most one pass over the ring.'''
+        limit = now - self.window - 2
+        if self._horizon is not None and limit <= self._horizon:
+            return
+        start = limit - self._size + 1
+        if self._horizon is not None:
+            start = max(start, self._horizon + 1)
+        for second in range(start, limit + 1):
+            index = second % self._size
+            if self._seconds[index] is not None and self._seconds[index] <= limit:
+                self._empty(index)
+        self._horizon = limit
+
+    def _bucket(self, second):
+        ''' Returns the index of the bucket of second, claiming it if free.'''
+        index = second % self._size
+        if self._seconds[index] != second:
+            self._empty(index)
+            self._seconds[index] = second
+        return index
+
+    def _drop_oldest(self, now):
+        ''' Drops the oldest second with nonces, to stay under max_entries.'''
+        live = [second for second in self._seconds if second is not None and self._buckets[second % self._size]]
+        oldest = min(live)
+        index = oldest % self._size
+        size = len(self._nonces)
+        self._empty(index)
+        self.dropped += size - len(self._nonces)
+        self._floor = oldest if self._floor is None else max(self._floor, oldest)
+
+    def check_and_add(self, nonce, timestamp):
+        ''' Records nonce, of a document with timestamp. Returns False if it
+            was already recorded or the timestamp is out of range.'''
+        now    = int(self.clock())
+        second = int(timestamp)
+        with self._lock:
+            self._advance(now)
+            if (second < now - self.window - 1 or second > now + self.window
+                    or (self._floor is not None and second <= self._floor)):
+                self.rejected += 1
+                return False
+
+            previous = self._nonces.get(nonce)
+            if previous is not None and previous >= now - self.window - 1:
+                self.replays += 1
+                return False
+
+            index = self._bucket(second)
+            if self.max_entries is not None and len(self._nonces) >= self.max_entries:
+                self._drop_oldest(now)
+                if self._floor is not None and second <= self._floor:
+                    self.rejected += 1
+                    return False
+
+            self._nonces[nonce] = second
+            self._buckets[index].append(nonce)
+            self.inserted += 1
+            return True
+
+    def clear(self):
+        with self._lock:
+            self._seconds = [None] * self._size
+            self._buckets = [[] for _ in range(self._size)]
+            self._nonces  = {}
+            self._floor   = None
+            self._horizon = None
+
+    def stats(self):
+        ''' Returns the counters and the number of nonces held.'''
+        return { 'size':     len(self._nonces),
+                 'inserted': self.inserted,
+                 'replays':  self.replays,
+                 'rejected': self.rejected,
+                 'dropped':  self.dropped, }
+
+
+# -- shared replay stores --
+#
+# ReplayCache lives in one process. With several worker processes every one
+# of them must see the nonces recorded by the others, so these stores keep
+# them outside the process. They all implement the ReplayCache interface
+# used by decrypt_json(), check_and_add() being a single atomic operation:
+#
+#     SharedMemoryReplayStore   hash table in a memory-mapped file, for
+#                               workers on one host, locked with flock()
+#     SQLiteReplayStore         table in a SQLite file in WAL mode
+#     PostgresReplayStore       UNLOGGED table, for workers on several hosts
+#
+# Every nonce is stored with the time it can be forgotten, its timestamp plus
+# the window. An expired entry counts as absent and is overwritten by the
+# check-and-insert itself, a cleanup pass removes the rest now and then.
+#
+# File descriptors and SQLite connections are not shared across fork(), the
+# file based stores reopen their file in each process that uses them.
+#
+
+def _expiry(timestamp, window):
+    return float(timestamp) + window + 1
+
+def _in_window(timestamp, now, window):
+    return now - window - 1 <= timestamp <= now + window
+
+class SharedMemoryReplayStore:
+    ''' Replay store in a memory-mapped file shared by the processes that
+        open the same path. Open addressing with linear probing; when no
+        slot is free within max_probe, new nonces are rejected.'''
+    SLOT = struct.Struct('<16sd') # nonce digest, expiry
+
+    def __init__(self, path, slots=1 << 16, window=FRESHNESS_WINDOW, max_probe=64, clock=_now):
+        if fcntl is None:
+            raise ValueError("SharedMemoryReplayStore needs fcntl, it is not available on this platform")
+        self.path      = path
+        self.slots     = slots
+        self.window    = window
+        self.max_probe = max_probe
+        self.clock     = clock
+        self._lock     = threading.Lock()
+        self.inserted = self.replays = self.rejected = 0
+
+        self._pid = None
+        self._open()
+
+    def _open(self):
+        ''' Opens the file in this process, flock() needs its own descriptor.'''
+        if self._pid == os.getpid():
+            return
+        size = self.slots * self.SLOT.size
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size < size:
+                os.ftruncate(self._fd, size) # new pages read as zeros, empty slots
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._map = mmap.mmap(self._fd, size)
+        self._pid = os.getpid()
+
+    @staticmethod
+    def _digest(nonce):
+        return hashlib.blake2b(nonce.encode('utf-8'), digest_size=16).digest()
+
+    def _probe(self, digest):
+        ''' Yields the slot offsets to look at for digest.'''
+        home = int.from_bytes(digest[:8], 'little') % self.slots
+        for step in range(min(self.max_probe, self.slots)):
+            yield ((home + step) % self.slots) * self.SLOT.size
+
+    def __contains__(self, nonce):
+        digest = self._digest(nonce)
+        now = self.clock()
+        with self._lock:
+            self._open()
+            for offset in self._probe(digest):
+                key, expiry = self.SLOT.unpack_from(self._map, offset)
+                if expiry == 0:
+                    return False
+                if key == digest and expiry >= now:
+                    return True
+        return False
+
+    def check_and_add(self, nonce, timestamp):
+        now = self.clock()
+        if not _in_window(timestamp, now, self.window):
+            self.rejected += 1
+            return False
+        digest = self._digest(nonce)
+        with self._lock:
+            self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                free = None
+                for offset in self._probe(digest):
+                    key, expiry = self.SLOT.unpack_from(self._map, offset)
+                    if key == digest and expiry >= now:
+                        self.replays += 1
+                        return False
+                    if expiry < now and free is None:
+                        free = offset
+                    if expiry == 0:
+                        break # never used, the nonce is not further on
+                if free is None:
+                    self.rejected += 1
+                    return False
+                self.SLOT.pack_into(self._map, free, digest, _expiry(timestamp, self.window))
+                self.inserted += 1
+                return True
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def clear(self):
+        with self._lock:
+            self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                self._map[:] = bytes(len(self._map))
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+    def stats(self):
+        return { 'inserted': self.inserted, 'replays': self.replays, 'rejected': self.rejected }
+
+class SQLiteReplayStore:
+    ''' Replay store in a SQLite file, shared by the processes that open it.'''
+    CLEANUP_INTERVAL = 10 # seconds
+
+    def __init__(self, path, window=FRESHNESS_WINDOW, clock=_now):
+        self.path   = path
+        self.window = window
+        self.clock  = clock
+        self._lock  = threading.Lock()
+        self._last_cleanup = 0
+        self.inserted = self.replays = self.rejected = 0
+
+        self._pid = None
+        self._connect()
+
+    def _connect(self):
+        ''' Connects in this process, connections do not survive fork().'''
+        if self._pid == os.getpid():
+            return
+        self._db = sqlite3.connect(self.path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS nonces (nonce TEXT PRIMARY KEY, expires REAL NOT NULL) WITHOUT ROWID')
+        self._pid = os.getpid()
+
+    def __contains__(self, nonce):
+        with self._lock:
+            self._connect()
+            row = self._db.execute('SELECT 1 FROM nonces WHERE nonce = ? AND expires >= ?',
+                                   (nonce, self.clock())).fetchone()
+        return row is not None
+
+    def check_and_add(self, nonce, timestamp):
+        now = self.clock()
+        if not _in_window(timestamp, now, self.window):
+            self.rejected += 1
+            return False
+        with self._lock:
+            self._connect()
+            # inserts, or takes over an expired row, in one statement
+            cursor = self._db.execute('INSERT INTO nonces (nonce, expires) VALUES (?, ?) '
+                                      'ON CONFLICT (nonce) DO UPDATE SET expires = excluded.expires '
+                                      'WHERE nonces.expires < ?',
+                                      (nonce, _expiry(timestamp, self.window), now))
+            added = cursor.rowcount == 1
+            if now - self._last_cleanup > self.CLEANUP_INTERVAL:
+                self._db.execute('DELETE FROM nonces WHERE expires < ?', (now,))
+                self._last_cleanup = now
+        if added:
+            self.inserted += 1
+        else:
+            self.replays += 1
+        return added
+
+    def clear(self):
+        with self._lock:
+            self._connect()
+            self._db.execute('DELETE FROM nonces')
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def stats(self):
+        return { 'inserted': self.inserted, 'replays': self.replays, 'rejected': self.rejected }
+
+class PostgresReplayStore:
+    ''' Replay store in an UNLOGGED PostgreSQL table, shared by every
+        process connected to the database. connection is a DB-API
+        connection, e.g. from psycopg2.connect(). Unlogged tables are not
+        crash safe, after a crash the nonces of the last window are lost.'''
+    CLEANUP_INTERVAL = 10 # seconds
+
+    def __init__(self, connection, table='ba_nonces', window=FRESHNESS_WINDOW, clock=_now):
+        if not table.isidentifier():
+            raise ValueError(f"Invalid table name '{table}'")
+        self.connection = connection
+        self.table  = table
+        self.window = window
+        self.clock  = clock
+        self._lock  = threading.Lock()
+        self._last_cleanup = 0
+        self.inserted = self.replays = self.rejected = 0
+
+        with self._lock, connection, connection.cursor() as db:
+            db.execute(f"CREATE UNLOGGED TABLE IF NOT EXISTS {table} ("
+                       f"nonce TEXT PRIMARY KEY, expires DOUBLE PRECISION NOT NULL);")
+
+    def __contains__(self, nonce):
+        with self._lock, self.connection, self.connection.cursor() as db:
+            db.execute(f"SELECT 1 FROM {self.table} WHERE nonce = (%s) AND expires >= (%s);",
+                       (nonce, self.clock()))
+            return db.fetchone() is not None
+
+    def check_and_add(self, nonce, timestamp):
+        now = self.clock()
+        if not _in_window(timestamp, now, self.window):
+            self.rejected += 1
+            return False
+        with self._lock, self.connection, self.connection.cursor() as db:
+            # inserts, or takes over an expired row, in one statement
+            db.execute(f"INSERT INTO {self.table} (nonce, expires) VALUES (%s, %s) "
+                       f"ON CONFLICT (nonce) DO UPDATE SET expires = EXCLUDED.expires "
+                       f"WHERE {self.table}.expires < (%s);",
+                       (nonce, _expiry(timestamp, self.window), now))
+            added = db.rowcount == 1
+            if now - self._last_cleanup > self.CLEANUP_INTERVAL:
+                db.execute(f"DELETE FROM {self.table} WHERE expires < (%s);", (now,))
+                self._last_cleanup = now
+        if added:
+            self.inserted += 1
+        else:
+            self.replays += 1
+        return added
+
+    def clear(self):
+        with self._lock, self.connection, self.connection.cursor() as db:
+            db.execute(f"DELETE FROM {self.table};")
+
+    def stats(self):
+        return { 'inserted': self.inserted, 'replays': self.replays, 'rejected': self.rejected }
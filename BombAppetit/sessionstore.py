@@ -0,0 +1,168 @@
+
+import os
+import sqlite3
+import threading
+from datetime import datetime
+
+from .functions import SESSION_LIFETIME, Session, create_session
+
+
+# -- login session stores --
+#
+# The server keeps the Session handed out to every logged-in user. With the
+# API on several worker processes a request can reach any of them, so the
+# sessions live in the same kind of shared backend as the nonces of
+# replay.py:
+#
+#     MemorySessionStore     one process
+#     SQLiteSessionStore     processes on this host
+#     PostgresSessionStore   every process using the database
+#
+# They share one interface:
+#
+#     start(user_name)       creates a Session, replacing the one user_name had
+#     get(session_id)        returns (user_name, Session), or (None, None) if
+#                            the session is unknown or expired
+#     purge(user_name=None)  drops expired sessions, and the one of user_name
+#
+# A user has at most one session. Session keys are stored as they are kept
+# in memory, the file or table must only be readable by the server.
+#
+
+def _cutoff():
+    ''' Sessions created before this are expired, see Session.expired().'''
+    return datetime.utcnow().timestamp() - SESSION_LIFETIME
+
+class MemorySessionStore:
+    ''' Sessions in a dict, for a single server process.'''
+    def __init__(self):
+        self._sessions = {} # session_id -> (user_name, Session)
+        self._lock     = threading.Lock()
+
+    def start(self, user_name):
+        session = create_session()
+        with self._lock:
+            self._purge(user_name)
+            self._sessions[session.session_id] = (user_name, session)
+        return session
+
+    def get(self, session_id):
+        with self._lock:
+            user_name, session = self._sessions.get(session_id, (None, None))
+            if session is not None and session.expired():
+                del self._sessions[session_id]
+                return None, None
+        return user_name, session
+
+    def purge(self, user_name=None):
+        with self._lock:
+            self._purge(user_name)
+
+    def _purge(self, user_name):
+        for session_id, (session_user, session) in list(self._sessions.items()):
+            if session.expired() or session_user == user_name:
+                del self._sessions[session_id]
+
+    def __len__(self):
+        return len(self._sessions)
+
+class SQLiteSessionStore:
+    ''' Sessions in a SQLite file, shared by the processes that open it. It
+        may be the file of a SQLiteReplayStore.'''
+    def __init__(self, path):
+        self.path  = path
+        self._lock = threading.Lock()
+
+        self._pid = None
+        self._connect()
+
+    def _connect(self):
+        ''' Connects in this process, connections do not survive fork().'''
+        if self._pid == os.getpid():
+            return
+        self._db = sqlite3.connect(self.path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, '
+                         'user_name TEXT UNIQUE NOT NULL, session_key BLOB NOT NULL, created REAL NOT NULL)')
+        self._pid = os.getpid()
+
+    def start(self, user_name):
+        session = create_session()
+        with self._lock:
+            self._connect()
+            # replaces the row of user_name, if any, in one statement
+            self._db.execute('INSERT INTO sessions (session_id, user_name, session_key, created) VALUES (?, ?, ?, ?) '
+                             'ON CONFLICT (user_name) DO UPDATE SET session_id = excluded.session_id, '
+                             'session_key = excluded.session_key, created = excluded.created',
+                             (session.session_id, user_name, session.session_key, session.created))
+            self._db.execute('DELETE FROM sessions WHERE created < ?', (_cutoff(),))
+        return session
+
+    def get(self, session_id):
+        with self._lock:
+            self._connect()
+            row = self._db.execute('SELECT user_name, session_key, created FROM sessions '
+                                   'WHERE session_id = ? AND created >= ?', (session_id, _cutoff())).fetchone()
+        if row is None:
+            return None, None
+        user_name, session_key, created = row
+        return user_name, Session(session_id, bytes(session_key), created)
+
+    def purge(self, user_name=None):
+        with self._lock:
+            self._connect()
+            self._db.execute('DELETE FROM sessions WHERE created < ? OR user_name = ?', (_cutoff(), user_name))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __len__(self):
+        with self._lock:
+            self._connect()
+            return self._db.execute('SELECT COUNT(*) FROM sessions').fetchone()[0]
+
+class PostgresSessionStore:
+    ''' Sessions in a PostgreSQL table, shared by every process connected to
+        the database. connection is a DB-API connection, e.g. from
+        psycopg2.connect(). The table is UNLOGGED like the nonces, after a
+        crash users log in again.'''
+    def __init__(self, connection, table='ba_sessions'):
+        if not table.isidentifier():
+            raise ValueError(f"Invalid table name '{table}'")
+        self.connection = connection
+        self.table = table
+        self._lock = threading.Lock()
+
+        with self._lock, connection, connection.cursor() as db:
+            db.execute(f"CREATE UNLOGGED TABLE IF NOT EXISTS {table} ("
+                       f"session_id TEXT PRIMARY KEY, user_name TEXT UNIQUE NOT NULL, "
+                       f"session_key BYTEA NOT NULL, created DOUBLE PRECISION NOT NULL);")
+
+    def start(self, user_name):
+        session = create_session()
+        with self._lock, self.connection, self.connection.cursor() as db:
+            # replaces the row of user_name, if any, in one statement
+            db.execute(f"INSERT INTO {self.table} (session_id, user_name, session_key, created) "
+                       f"VALUES (%s, %s, %s, %s) "
+                       f"ON CONFLICT (user_name) DO UPDATE SET session_id = EXCLUDED.session_id, "
+                       f"session_key = EXCLUDED.session_key, created = EXCLUDED.created;",
+                       (session.session_id, user_name, session.session_key, session.created))
+            db.execute(f"DELETE FROM {self.table} WHERE created < (%s);", (_cutoff(),))
+        return session
+
+    def get(self, session_id):
+        with self._lock, self.connection, self.connection.cursor() as db:
+            db.execute(f"SELECT user_name, session_key, created FROM {self.table} "
+                       f"WHERE session_id = (%s) AND created >= (%s);", (session_id, _cutoff()))
+            row = db.fetchone()
+        if row is None:
+            return None, None
+        user_name, session_key, created = row
+        return user_name, Session(session_id, bytes(session_key), created)
+
+    def purge(self, user_name=None):
+        with self._lock, self.connection, self.connection.cursor() as db:
+            db.execute(f"DELETE FROM {self.table} WHERE created < (%s) OR user_name = (%s);",
+                       (_cutoff(), user_name))
@@ -0,0 +1,148 @@
+
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from base64 import b64decode
+
+from .functions import _as_envelope, test_json_hash, test_merkle_items, key_fingerprint
+
+
+# -- verified-signature cache --
+#
+# Signed documents that never change, like stored reviews, are verified again
+# every time they are read. A VerifyCache remembers the signatures it has
+# already checked, keyed by
+#
+#     sha256(sha256(content) + signature + signer key fingerprint)
+#
+# so a document seen before costs a hash instead of an RSA verify. Only
+# successful verifications are stored, a changed content, signature or key
+# gives a different entry and is verified in full.
+#
+# Entries live in an in-memory LRU, and with path also in a SQLite file so
+# they survive restarts. Lookups try memory first and promote disk hits.
+#
+
+class MemoryVerifyStore:
+    ''' In-memory LRU set of verified entries.'''
+    def __init__(self, maxsize=4096):
+        self.maxsize  = maxsize
+        self._entries = OrderedDict()
+        self._lock    = threading.Lock()
+
+    def contains(self, entry):
+        with self._lock:
+            if entry not in self._entries:
+                return False
+            self._entries.move_to_end(entry)
+            return True
+
+    def add(self, entry):
+        with self._lock:
+            self._entries[entry] = None
+            self._entries.move_to_end(entry)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+class SQLiteVerifyStore:
+    ''' On-disk set of verified entries in a SQLite file.'''
+    def __init__(self, path):
+        self.path  = path
+        self._lock = threading.Lock()
+        self._db   = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS verified (entry BLOB PRIMARY KEY) WITHOUT ROWID')
+
+    def contains(self, entry):
+        with self._lock:
+            row = self._db.execute('SELECT 1 FROM verified WHERE entry = ?', (entry,)).fetchone()
+        return row is not None
+
+    def add(self, entry):
+        with self._lock:
+            self._db.execute('INSERT OR IGNORE INTO verified (entry) VALUES (?)', (entry,))
+
+    def clear(self):
+        with self._lock:
+            self._db.execute('DELETE FROM verified')
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM verified').fetchone()[0]
+
+class VerifyCache:
+    ''' Cache of verified signatures, see above. Use verify() in place of
+        test_json_hash(), or pass the cache to decrypt_json().'''
+    def __init__(self, maxsize=4096, path=None):
+        self.memory = MemoryVerifyStore(maxsize)
+        self.disk   = SQLiteVerifyStore(path) if path is not None else None
+        self.hits   = 0
+        self.misses = 0
+
+    @staticmethod
+    def entry(encrypted_document, src_public_key):
+        ''' Returns the cache entry of a signed document and signer key.'''
+        envelope = _as_envelope(encrypted_document)
+        signature = b64decode(envelope.get('signature').encode())
+        return hashlib.sha256(envelope.digest.digest() + signature
+                              + key_fingerprint(src_public_key).encode()).digest()
+
+    def contains(self, entry):
+        if self.memory.contains(entry):
+            return True
+        if self.disk is not None and self.disk.contains(entry):
+            self.memory.add(entry)
+            return True
+        return False
+
+    def add(self, entry):
+        self.memory.add(entry)
+        if self.disk is not None:
+            self.disk.add(entry)
+
+    def is_verified(self, encrypted_document, src_public_key):
+        ''' Returns True if the signature is known good, without verifying.'''
+        try:
+            return self.contains(self.entry(encrypted_document, src_public_key))
+        except (ValueError, TypeError, AttributeError):
+            return False
+
+    def verify(self, encrypted_document, src_public_key):
+        ''' Like test_json_hash(), raises ValueError if the signature is
+            invalid, but skips signatures verified before.'''
+        envelope = _as_envelope(encrypted_document)
+        try:
+            entry = self.entry(envelope, src_public_key)
+        except (TypeError, AttributeError):
+            raise ValueError("Document has no valid signature")
+
+        if self.contains(entry):
+            self.hits += 1
+            # the signature covers the Merkle root, not the items
+            test_merkle_items(envelope)
+            return
+        self.misses += 1
+        test_json_hash(envelope, src_public_key)
+        self.add(entry)
+
+    def clear(self):
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+    def stats(self):
+        ''' Returns the hit and miss counters and the number of entries.'''
+        return { 'hits': self.hits, 'misses': self.misses, 'size': len(self.memory) }
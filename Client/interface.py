@@ -1,8 +1,8 @@
 import os
 import sys
 import json
+import atexit
 import requests
-from datetime import datetime
 
 import warnings
 from urllib3.exceptions import SubjectAltNameWarning
@@ -15,28 +15,10 @@ except ImportError:
     print("Import failed. Install dependencies with: pip3 install -r requirements.txt")
     sys.exit(1)
 
-seen_nonces_by_time = {}
+replay_cache = BA.ReplayCache() # nonces seen in the freshness window
 
-def get_seen_nonces():
-    ''' Returns a set of the seen nonces.'''
-    seen_nonces = set()
-    for second in seen_nonces_by_time:
-        seen_nonces.update(seen_nonces_by_time[second])
-    return seen_nonces
-
-def update_seen_nonces(nonce):
-    ''' Adds a nonce to the seen nonces for the current second.
-        Also, removes nonces older than a minute.'''
-    current_second = int(datetime.utcnow().timestamp())
-    if current_second not in seen_nonces_by_time:
-        seen_nonces_by_time[current_second] = set({nonce})
-
-    to_delete = []
-    for second in seen_nonces_by_time:
-        if second < current_second - 60:
-            to_delete.append(second)
-    for second in to_delete:
-        seen_nonces_by_time.pop(second)
+# reviews never change once written, their signatures are verified only once
+verify_cache = BA.VerifyCache(path='verified_signatures.sqlite')
 
 
 def read_json_file(file_path):
@@ -51,10 +33,19 @@ def read_json_file(file_path):
             print("Invalid JSON format.")
             return None
 
-def https_post_requests(url, data, certificate_client_path, key_path, certificate_server_path):
+def https_post_requests(url, data, certificate_client_path, key_path, certificate_server_path, binary=True):
         try:
-            response = requests.post(url, json=data, cert=(certificate_client_path, key_path), verify=certificate_server_path)
-            data = response.json()
+            if binary:
+                # send and ask for the compact binary format
+                headers = {'Content-Type': BA.BINARY_CONTENT_TYPE, 'Accept': BA.BINARY_CONTENT_TYPE}
+                response = requests.post(url, data=BA.pack_document(data), headers=headers, cert=(certificate_client_path, key_path), verify=certificate_server_path)
+            else:
+                response = requests.post(url, json=data, cert=(certificate_client_path, key_path), verify=certificate_server_path)
+
+            if response.headers.get('Content-Type', '').startswith(BA.BINARY_CONTENT_TYPE):
+                data = BA.unpack_document(response.content)
+            else:
+                data = response.json()
             status_code = response.status_code
             return [data, status_code]
         except requests.exceptions.HTTPError as errh:
@@ -77,6 +68,7 @@ class ClientInterface:
         self.pubkey = None
         self.server_pubkey = BA.load_public_key(server_public_key_path)
         self.user_keys = {}
+        self.session = None
 
     # --- USER ---
 
@@ -99,15 +91,13 @@ class ClientInterface:
         private_key = BA.str_to_key(self.privkey.decode())
         server_public_key = BA.str_to_key(self.server_pubkey.decode())
 
-        data = BA.encrypt_json(user_data, private_key, None)
+        data = BA.encrypt_json(user_data, private_key, None, session=self.session)
         response = https_post_requests(self.base_url + '/users', data, self.certificate_client_path, self.key_path, self.certificate_server_path)
         if response[1] == 201:
-            _, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=get_seen_nonces())
-            update_seen_nonces(nonce)
+            _, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=replay_cache, session=self.session)
             print("User created successfully.")
         elif response[1] == 400:
-            json_object, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=get_seen_nonces())
-            update_seen_nonces(nonce)
+            json_object, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=replay_cache, session=self.session)
             error_message = json_object.get('error')
             print(error_message)
 
@@ -124,15 +114,15 @@ class ClientInterface:
         private_key = BA.str_to_key(self.privkey.decode())
         server_public_key = BA.str_to_key(self.server_pubkey.decode())
 
-        data = BA.encrypt_json(login_data, private_key, None)
+        data = BA.encrypt_json(login_data, private_key, None, session=self.session)
         response = https_post_requests(self.base_url + '/users', data, self.certificate_client_path, self.key_path, self.certificate_server_path)
         if response[1] == 200:
-            _, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=get_seen_nonces())
-            update_seen_nonces(nonce)
+            json_object, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=replay_cache, session=self.session)
+            # following requests are authenticated with the session key
+            self.session = BA.load_session(json_object)
             print("User logged in successfully.")
         else:
-            json_object, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=get_seen_nonces())
-            update_seen_nonces(nonce)
+            json_object, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=replay_cache, session=self.session)
             error_message = json_object.get('error')
             print(error_message)
 
@@ -150,17 +140,15 @@ class ClientInterface:
         private_key_old = BA.str_to_key(self.privkey.decode())
         server_public_key = BA.str_to_key(self.server_pubkey.decode())
 
-        data = BA.encrypt_json(update_json, private_key_old, None) 
+        data = BA.encrypt_json(update_json, private_key_old, None, session=self.session)
         response= https_post_requests(self.base_url + '/users', data, self.certificate_client_path, self.key_path, self.certificate_server_path)
         if response[1] == 200:
-            _, nonce = BA.decrypt_json(response[0], server_public_key, private_key_old, seen_nonces=get_seen_nonces())
-            update_seen_nonces(nonce)
+            _, nonce = BA.decrypt_json(response[0], server_public_key, private_key_old, seen_nonces=replay_cache, session=self.session)
             self.privkey = private_key
             self.pubkey = public_key
             print("User updated successfully.")
         elif response[1] == 400:
-            json_object, nonce = BA.decrypt_json(response[0], server_public_key, private_key_old, seen_nonces=get_seen_nonces())
-            update_seen_nonces(nonce)
+            json_object, nonce = BA.decrypt_json(response[0], server_public_key, private_key_old, seen_nonces=replay_cache, session=self.session)
             error_message = json_object.get('error')
             print(error_message)
 
@@ -174,16 +162,14 @@ class ClientInterface:
         private_key = BA.str_to_key(self.privkey.decode())
         server_public_key = BA.str_to_key(self.server_pubkey.decode())
 
-        data = BA.encrypt_json(read_json, private_key, None)
+        data = BA.encrypt_json(read_json, private_key, None, session=self.session)
         response = https_post_requests(self.base_url + '/users', data, self.certificate_client_path, self.key_path, self.certificate_server_path)
         if response[1] == 200:
-            json_object, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=get_seen_nonces())
-            update_seen_nonces(nonce)
+            json_object, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=replay_cache, session=self.session)
             public_key = json_object.get('public_key')
             print("User: " + username + "\nPublic key: " + public_key + "\n")
         else:
-            json_object, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=get_seen_nonces())
-            update_seen_nonces(nonce)
+            json_object, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=replay_cache, session=self.session)
             error_message = json_object.get('error')
             print(error_message)
 
@@ -197,18 +183,17 @@ class ClientInterface:
         private_key = BA.str_to_key(self.privkey.decode())
         server_public_key = BA.str_to_key(self.server_pubkey.decode())
 
-        data = BA.encrypt_json(list_users, private_key, None)
+        data = BA.encrypt_json(list_users, private_key, None, session=self.session)
         response = https_post_requests(self.base_url + '/users', data, self.certificate_client_path, self.key_path, self.certificate_server_path)
 
         if response[1] == 200:
-            json_object, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=get_seen_nonces())
-            update_seen_nonces(nonce)
+            json_object, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=replay_cache, session=self.session)
 
             users = json_object.get('users')
             for user in users:
                 print("User: " + user.get('name') + "\nPublic key: " + user.get('public_key') + "\n")
         else:
-            json_object, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=get_seen_nonces())
+            json_object, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=replay_cache, session=self.session)
             error_message = json_object.get('error')
             print(error_message)
 
@@ -222,17 +207,15 @@ class ClientInterface:
         private_key = BA.str_to_key(self.privkey.decode())
         server_public_key = BA.str_to_key(self.server_pubkey.decode())
 
-        data = BA.encrypt_json(delete_json, private_key, None)
+        data = BA.encrypt_json(delete_json, private_key, None, session=self.session)
         response = https_post_requests(self.base_url + '/users', data, self.certificate_client_path, self.key_path, self.certificate_server_path)
         if response[1] == 200:
-            _, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=get_seen_nonces())
-            update_seen_nonces(nonce)
+            _, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=replay_cache, session=self.session)
             os.remove('keys/' + username + '.pubkey')
             os.remove('keys/' + username + '.privkey')
             print("User deleted successfully.")
         else:
-            json_object, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=get_seen_nonces())
-            update_seen_nonces(nonce)
+            json_object, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=replay_cache, session=self.session)
             error_message = json_object.get('error')
             print(error_message)
 
@@ -248,15 +231,13 @@ class ClientInterface:
         private_key = BA.str_to_key(self.privkey.decode())
         server_public_key = BA.str_to_key(self.server_pubkey.decode())
 
-        data = BA.encrypt_json(create_json, private_key, None)
+        data = BA.encrypt_json(create_json, private_key, None, session=self.session)
         response = https_post_requests(self.base_url + '/restaurants', data, self.certificate_client_path, self.key_path, self.certificate_server_path)
         if response[1] == 201:
-            json_object, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=get_seen_nonces())
-            update_seen_nonces(nonce)
+            json_object, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=replay_cache, session=self.session)
             print("Restaurant created successfully with id " + str(json_object.get('id')) + " .")
         else:
-            json_object, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=get_seen_nonces())
-            update_seen_nonces(nonce)
+            json_object, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=replay_cache, session=self.session)
             error_message = json_object.get('error')
             print(error_message)
 
@@ -268,12 +249,11 @@ class ClientInterface:
         private_key = BA.str_to_key(self.privkey.decode())
         server_public_key = BA.str_to_key(self.server_pubkey.decode())
 
-        data = BA.encrypt_json(list_users, private_key, None)
+        data = BA.encrypt_json(list_users, private_key, None, session=self.session)
         response = https_post_requests(self.base_url + '/users', data, self.certificate_client_path, self.key_path, self.certificate_server_path)
 
         if response[1] == 200:
-            json_object, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=get_seen_nonces())
-            update_seen_nonces(nonce)
+            json_object, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=replay_cache, session=self.session)
 
             users = json_object.get('users')
             for user in users:
@@ -288,11 +268,10 @@ class ClientInterface:
         private_key = BA.str_to_key(self.privkey.decode())
         server_public_key = BA.str_to_key(self.server_pubkey.decode())
 
-        data = BA.encrypt_json(read_json, private_key, None)
+        data = BA.encrypt_json(read_json, private_key, None, session=self.session)
         response = https_post_requests(self.base_url + '/restaurants', data, self.certificate_client_path, self.key_path, self.certificate_server_path)
         if response[1] == 200:
-            restaurantInfo, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=get_seen_nonces())
-            update_seen_nonces(nonce)
+            restaurantInfo, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=replay_cache, session=self.session)
 
             reviews = restaurantInfo.pop('reviews')
 
@@ -302,18 +281,19 @@ class ClientInterface:
             if len(reviews) > 0:
                 print("\nReviews: ")
                 self.get_all_user_keys()
-                for review in reviews:
-                    content = json.loads(review['review'].get('content')).get('json')
-                    username = content.get('user_name')
-                    user_key = self.user_keys.get(username)
-                    user_key = BA.str_to_key(user_key)
-                    rev, _ = BA.decrypt_json(review['review'], user_key, None, freshness_check=False)
-                    print(rev)
+                # verify every review at once, across processes
+                envelopes = [BA.Envelope(review['review']) for review in reviews]
+                user_keys = [BA.str_to_key(self.user_keys.get(envelope.user_name)) for envelope in envelopes]
+                for rev, error in BA.decrypt_many(envelopes, user_keys, None, freshness_check=False,
+                                                 verify_cache=verify_cache):
+                    if rev is None:
+                        print("Invalid review: " + error)
+                    else:
+                        print(rev)
                 print()
                     
         else:
-            json_object, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=get_seen_nonces())
-            update_seen_nonces(nonce)
+            json_object, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=replay_cache, session=self.session)
             error_message = json_object.get('error')
             print(error_message)
 
@@ -326,11 +306,10 @@ class ClientInterface:
         private_key = BA.str_to_key(self.privkey.decode())
         server_public_key = BA.str_to_key(self.server_pubkey.decode())
 
-        data = BA.encrypt_json(list_json, private_key, None)
+        data = BA.encrypt_json(list_json, private_key, None, session=self.session)
         response = https_post_requests(self.base_url + '/restaurants', data, self.certificate_client_path, self.key_path, self.certificate_server_path)
         if response[1] == 200:
-            json_object, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=get_seen_nonces())
-            update_seen_nonces(nonce)
+            json_object, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=replay_cache, session=self.session)
 
             restaurants = json_object.get('restaurants')
             if restaurants is None:
@@ -350,15 +329,13 @@ class ClientInterface:
         private_key = BA.str_to_key(self.privkey.decode())
         server_public_key = BA.str_to_key(self.server_pubkey.decode())
 
-        data = BA.encrypt_json(delete_json, private_key, None)
+        data = BA.encrypt_json(delete_json, private_key, None, session=self.session)
         response = https_post_requests(self.base_url + '/restaurants', data, self.certificate_client_path, self.key_path, self.certificate_server_path)
         if response[1] == 200:
-            _, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=get_seen_nonces())
-            update_seen_nonces(nonce)
+            _, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=replay_cache, session=self.session)
             print("Restaurant deleted successfully.")
         else:
-            json_object, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=get_seen_nonces())
-            update_seen_nonces(nonce)
+            json_object, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=replay_cache, session=self.session)
             error_message = json_object.get('error')
             print(error_message)
 
@@ -374,15 +351,13 @@ class ClientInterface:
         private_key = BA.str_to_key(self.privkey.decode())
         server_public_key = BA.str_to_key(self.server_pubkey.decode())
 
-        data = BA.encrypt_json(update_json, private_key, None)
+        data = BA.encrypt_json(update_json, private_key, None, session=self.session)
         response = https_post_requests(self.base_url + '/restaurants', data, self.certificate_client_path, self.key_path, self.certificate_server_path)
         if response[1] == 200:
-            _, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=get_seen_nonces())
-            update_seen_nonces(nonce)
+            _, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=replay_cache, session=self.session)
             print("Restaurant updated successfully.")
         else:
-            json_object, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=get_seen_nonces())
-            update_seen_nonces(nonce)
+            json_object, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=replay_cache, session=self.session)
             error_message = json_object.get('error')
             print(error_message)
 
@@ -399,16 +374,14 @@ class ClientInterface:
         }
         private_key = BA.str_to_key(self.privkey.decode())
         server_public_key = BA.str_to_key(self.server_pubkey.decode())
-        data = BA.encrypt_json(data, private_key, server_public_key, sections_to_encrypt=['code', 'description'])
+        data = BA.encrypt_json(data, private_key, server_public_key, sections_to_encrypt=['code', 'description'], session=self.session, mode='GCM')
 
         response = https_post_requests(self.base_url + '/vouchers', data, self.certificate_client_path, self.key_path, self.certificate_server_path)
         if response[1] == 201:
-            _, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=get_seen_nonces())
-            update_seen_nonces(nonce)
+            _, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=replay_cache, session=self.session)
             print("Voucher created successfully.")
         else:
-            json_object, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=get_seen_nonces())
-            update_seen_nonces(nonce)
+            json_object, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=replay_cache, session=self.session)
             error_message = json_object.get('error')
             print(error_message)
 
@@ -419,14 +392,14 @@ class ClientInterface:
             'operation': 'list'
         }
         private_key = BA.str_to_key(self.privkey.decode())
-        data = BA.encrypt_json(list_json, private_key, None)
+        data = BA.encrypt_json(list_json, private_key, None, session=self.session)
         response = https_post_requests(self.base_url + '/vouchers', data, self.certificate_client_path, self.key_path, self.certificate_server_path)
 
         response_data = response[0]
 
         server_public_key = BA.str_to_key(self.server_pubkey.decode())
-        content, nonce = BA.decrypt_json(response_data, server_public_key, private_key, seen_nonces=get_seen_nonces())
-        update_seen_nonces(nonce)
+        content, nonce = BA.decrypt_json(response_data, server_public_key, private_key, seen_nonces=replay_cache, session=self.session,
+                                         only_sections=['vouchers'])
         vouchers = content.get('vouchers')
 
         if vouchers is None:
@@ -448,15 +421,13 @@ class ClientInterface:
         private_key = BA.str_to_key(self.privkey.decode())
         server_public_key = BA.str_to_key(self.server_pubkey.decode())
 
-        data = BA.encrypt_json(transfer_json, private_key, server_public_key, sections_to_encrypt=['code'])
+        data = BA.encrypt_json(transfer_json, private_key, server_public_key, sections_to_encrypt=['code'], session=self.session, mode='GCM')
         response = https_post_requests(self.base_url + '/vouchers', data, self.certificate_client_path, self.key_path, self.certificate_server_path)
         if response[1] == 200:
-            _, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=get_seen_nonces())
-            update_seen_nonces(nonce)
+            _, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=replay_cache, session=self.session)
             print("Voucher transferred successfully.")
         else:
-            json_object, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=get_seen_nonces())
-            update_seen_nonces(nonce)
+            json_object, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=replay_cache, session=self.session)
             error_message = json_object.get('error')
             print(error_message)
 
@@ -470,15 +441,13 @@ class ClientInterface:
         private_key = BA.str_to_key(self.privkey.decode())
         server_public_key = BA.str_to_key(self.server_pubkey.decode())
         
-        data = BA.encrypt_json(use_json, private_key, server_public_key, sections_to_encrypt=['code'])
+        data = BA.encrypt_json(use_json, private_key, server_public_key, sections_to_encrypt=['code'], session=self.session, mode='GCM')
         response = https_post_requests(self.base_url + '/vouchers', data, self.certificate_client_path, self.key_path, self.certificate_server_path)
         if response[1] == 200:
-            _, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=get_seen_nonces())
-            update_seen_nonces(nonce)
+            _, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=replay_cache, session=self.session)
             print("Voucher used successfully.")
         else:
-            json_object, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=get_seen_nonces())
-            update_seen_nonces(nonce)
+            json_object, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=replay_cache, session=self.session)
             error_message = json_object.get('error')
             print(error_message)
 
@@ -499,15 +468,13 @@ class ClientInterface:
             'review': review,
             'operation': 'create'
         }
-        data = BA.encrypt_json(write_json, private_key, None)
+        data = BA.encrypt_json(write_json, private_key, None, session=self.session)
         response = https_post_requests(self.base_url + '/reviews', data, self.certificate_client_path, self.key_path, self.certificate_server_path)
         if response[1] == 201:
-            _, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=get_seen_nonces())
-            update_seen_nonces(nonce)
+            _, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=replay_cache, session=self.session)
             print("Review created successfully.")
         else:
-            json_object, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=get_seen_nonces())
-            update_seen_nonces(nonce)
+            json_object, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=replay_cache, session=self.session)
             error_message = json_object.get('error')
             print(error_message)
 
@@ -520,11 +487,10 @@ class ClientInterface:
         private_key = BA.str_to_key(self.privkey.decode())
         server_public_key = BA.str_to_key(self.server_pubkey.decode())
 
-        data = BA.encrypt_json(read_json, private_key, None)
+        data = BA.encrypt_json(read_json, private_key, None, session=self.session)
         response = https_post_requests(self.base_url + '/reviews', data, self.certificate_client_path, self.key_path, self.certificate_server_path)
         if response[1] == 200:
-            json_object, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=get_seen_nonces())
-            update_seen_nonces(nonce)
+            json_object, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=replay_cache, session=self.session)
             
             reviews = json_object.get('reviews')
             if reviews is None:
@@ -536,8 +502,7 @@ class ClientInterface:
                 comment = rev.get('comment')
                 print("\nReview_Score: " + score + "| Review_Comment: " + comment + "| Restaurant: " + str(review['restaurant_id']) + "\n")
         else:
-            json_object, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=get_seen_nonces())
-            update_seen_nonces(nonce)
+            json_object, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=replay_cache, session=self.session)
             error_message = json_object.get('error')
             print(error_message)
 
@@ -558,15 +523,13 @@ class ClientInterface:
             'operation': 'update'
         }
         
-        data = BA.encrypt_json(update_json, private_key, None)
+        data = BA.encrypt_json(update_json, private_key, None, session=self.session)
         response = https_post_requests(self.base_url + '/reviews', data, self.certificate_client_path, self.key_path, self.certificate_server_path)
         if response[1] == 200:
-            _, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=get_seen_nonces())
-            update_seen_nonces(nonce)
+            _, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=replay_cache, session=self.session)
             print("Review updated successfully.")
         else:
-            json_object, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=get_seen_nonces())
-            update_seen_nonces(nonce)
+            json_object, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=replay_cache, session=self.session)
             error_message = json_object.get('error')
             print(error_message)
 
@@ -580,15 +543,13 @@ class ClientInterface:
         private_key = BA.str_to_key(self.privkey.decode())
         server_public_key = BA.str_to_key(self.server_pubkey.decode())
 
-        data = BA.encrypt_json(delete_json, private_key, None)
+        data = BA.encrypt_json(delete_json, private_key, None, session=self.session)
         response = https_post_requests(self.base_url + '/reviews', data, self.certificate_client_path, self.key_path, self.certificate_server_path)
         if response[1] == 200:
-            _, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=get_seen_nonces())
-            update_seen_nonces(nonce)
+            _, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=replay_cache, session=self.session)
             print("Review deleted successfully.")
         else:
-            json_object, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=get_seen_nonces())
-            update_seen_nonces(nonce)
+            json_object, nonce = BA.decrypt_json(response[0], server_public_key, private_key, seen_nonces=replay_cache, session=self.session)
             error_message = json_object.get('error')
             print(error_message)    
 
@@ -796,6 +757,15 @@ if __name__ == "__main__":
     key_path = "certificate/key.pem"
     server_public_key_path = "keys/public_server_key.key"
 
+    # generate keys in the background while the user types, register and
+    # update then take one without waiting
+    BA.set_key_pool(BA.KeyPool(sizes=(2048,), target=2).start())
+
+    # BA_INSTRUMENT=1 prints where the session spent its crypto time on exit
+    if os.environ.get('BA_INSTRUMENT') == '1':
+        phase_stats = BA.PhaseStats().start()
+        atexit.register(lambda: print(phase_stats.report(), file=sys.stderr))
+
     username = input("Enter your username: ")
     client = ClientInterface(base_url, username, certificate_server_path, certificate_client_path, key_path, server_public_key_path)
     client.InterfaceMenu()
@@ -1,6 +1,7 @@
+import os
 import sys
+import gzip
 import json
-from datetime import datetime
 
 import psycopg2
 from sshtunnel import SSHTunnelForwarder
@@ -14,9 +15,15 @@ except ImportError:
 
 from flask import Flask
 from flask import request
+from flask import g
 
 
 app = Flask(__name__)
+# reject oversized requests before they are even parsed
+app.config['MAX_CONTENT_LENGTH'] = BA.MAX_DOCUMENT_SIZE
+
+# BA_INSTRUMENT=1 prints where each request spent its crypto time
+INSTRUMENT = os.environ.get('BA_INSTRUMENT') == '1'
 
 tunnel =  SSHTunnelForwarder(
         ("192.168.0.100", 22),
@@ -47,12 +54,47 @@ CREATE_TABLES = """
                         restaurant_id   SERIAL REFERENCES ba_restaurants (id),
                         user_name       TEXT REFERENCES ba_users (name),
                         UNIQUE (restaurant_id, user_name)
-                );"""
+                );
+                ALTER TABLE ba_restaurants ADD COLUMN IF NOT EXISTS fragment JSONB;"""
 with database, database.cursor() as db:
     db.execute(CREATE_TABLES)
 
 cached_users = {}
-seen_nonces_by_time = {}
+
+def open_replay_store(spec):
+    ''' Returns the store of seen nonces named by BA_REPLAY_STORE:
+        memory (default, one process), mmap:<path> (processes on this
+        host), sqlite:<path> (processes on this host), or postgres (every
+        process using the database).'''
+    kind, _, path = spec.partition(':')
+    if kind == 'memory':
+        return BA.ReplayCache()
+    if kind == 'mmap':
+        return BA.SharedMemoryReplayStore(path or 'seen_nonces.mmap')
+    if kind == 'sqlite':
+        return BA.SQLiteReplayStore(path or 'seen_nonces.sqlite')
+    if kind == 'postgres':
+        return BA.PostgresReplayStore(database)
+    print(f"Unknown BA_REPLAY_STORE '{spec}'")
+    sys.exit(1)
+
+def open_session_store(spec):
+    ''' Returns the store of login sessions, in the same backend as the
+        replay store named by BA_REPLAY_STORE. mmap has no table of its
+        own, its sessions go in a SQLite file next to it.'''
+    kind, _, path = spec.partition(':')
+    if kind == 'mmap':
+        return BA.SQLiteSessionStore(os.path.splitext(path or 'seen_nonces.mmap')[0] + '_sessions.sqlite')
+    if kind == 'sqlite':
+        return BA.SQLiteSessionStore(path or 'seen_nonces.sqlite')
+    if kind == 'postgres':
+        return BA.PostgresSessionStore(database)
+    return BA.MemorySessionStore()
+
+# nonces seen in the freshness window and login sessions, shared between
+# workers unless memory
+replay_cache  = open_replay_store(os.environ.get('BA_REPLAY_STORE', 'memory'))
+session_store = open_session_store(os.environ.get('BA_REPLAY_STORE', 'memory'))
 
 key_path = 'keys/private_server_key.pem'
 server_private_key, server_public_key = BA.load_keypair(key_path)
@@ -60,43 +102,41 @@ if server_private_key is None or server_public_key is None:
     print(f"Could not load server keypair from '{key_path}'")
     sys.exit(1)
 
-def get_seen_nonces():
-    ''' Returns a set of the seen nonces.'''
-    seen_nonces = set()
-    for second in seen_nonces_by_time:
-        seen_nonces.update(seen_nonces_by_time[second])
-    return seen_nonces
-
-def update_seen_nonces(nonce):
-    ''' Adds a nonce to the seen nonces for the current second.
-        Also, removes nonces older than a minute.'''
-    current_second = int(datetime.utcnow().timestamp())
-    if current_second not in seen_nonces_by_time:
-        seen_nonces_by_time[current_second] = set({nonce})
-
-    to_delete = []
-    for second in seen_nonces_by_time:
-        if second < current_second - 60:
-            to_delete.append(second)
-    for second in to_delete:
-        seen_nonces_by_time.pop(second)
-
 def is_register_operation(message):
     if not ('public_key' in message and 'operation' in message and message['operation'] == 'create'):
         return False
     cached_users[message['user_name']] = message['public_key']
     return True
 
+def get_json_request():
+    ''' Returns the request document, sent as JSON or in the binary format.'''
+    if request.mimetype == BA.BINARY_CONTENT_TYPE:
+        try:
+            return BA.unpack_document(request.get_data())
+        except ValueError:
+            return {}
+    return request.get_json()
+
 def read_json_request(json_request):
     ''' Reads and validates JSON message.
         Returns message and user name if valid, else None and error message.'''
-    if 'content' not in json_request or 'signature' not in json_request:
+    if 'content' not in json_request or ('signature' not in json_request and 'mac' not in json_request):
         return None, "Invalid request: missing content or signature"
 
-    message = json.loads(json_request.get('content')).get('json')
-    if 'user_name' not in message:
+    try:
+        # parsed once, shared with decrypt_json
+        envelope = BA.Envelope(json_request)
+    except (ValueError, KeyError) as e:
+        return None, f"Invalid request: {e}"
+
+    # only a MAC authenticates a session request, see decrypt_json
+    if 'mac' in json_request:
+        return read_session_request(envelope)
+
+    message = envelope.json
+    if envelope.user_name is None:
         return None, "Invalid request: missing user_name"
-    user_name = message['user_name']
+    user_name = envelope.user_name
 
     if user_name not in cached_users:
         with database, database.cursor() as db:
@@ -111,33 +151,94 @@ def read_json_request(json_request):
     user_public_key = BA.str_to_key(cached_users[user_name])
 
     try:
-        json_message, nonce = BA.decrypt_json(json_request, user_public_key, server_private_key, seen_nonces=get_seen_nonces())
+        json_message, nonce = BA.decrypt_json(envelope, user_public_key, server_private_key, seen_nonces=replay_cache)
         if json_message is None:
             return None, f"Invalid request: {nonce}"
-        update_seen_nonces(nonce)
     except ValueError as e:
         return None, f"Invalid request: {e}"
 
     return json_message, user_name
 
-def send_json_response(json_response, status_code, user_name=None, sections_to_encrypt=None):
+def read_session_request(envelope):
+    ''' Reads and validates JSON message sent under a login session.
+        Returns message and user name if valid, else None and error message.'''
+    user_name, session = session_store.get(envelope.session)
+    if session is None:
+        return None, "Invalid request: unknown or expired session"
+
+    try:
+        json_message, nonce = BA.decrypt_json(envelope, None, None, seen_nonces=replay_cache, session=session)
+        if json_message is None:
+            return None, f"Invalid request: {nonce}"
+    except ValueError as e:
+        return None, f"Invalid request: {e}"
+
+    if json_message.get('user_name') != user_name:
+        return None, "Invalid request: session belongs to another user"
+
+    # responses to this request are sent under the same session
+    g.session = session
+    return json_message, user_name
+
+def sign_restaurant(restaurant_id, data):
+    ''' Returns the signed fragment of a restaurant, as sent by list.'''
+    return BA.sign_fragment({"id": restaurant_id, "data": data}, server_private_key)
+
+def send_json_response(json_response, status_code, user_name=None, sections_to_encrypt=None, merkle_section=None):
     ''' Creates proper JSON response.
         Only use user_name if you want to encrypt the response.
-        Only use sections_to_encrypt if you want mixed encryption.'''    
+        Only use sections_to_encrypt if you want mixed encryption.
+        Only use merkle_section for a list of pre-signed fragments.
+        Requests that came in under a session are answered under it.
+        Clients accepting the binary format get the response in it.'''
     if user_name is not None:
         user_public_key = BA.str_to_key(cached_users[user_name])
     else:
         # no user name, no public key, no encryption
         user_public_key = None
 
-    return BA.encrypt_json(json_response, server_private_key, user_public_key, sections_to_encrypt=sections_to_encrypt), status_code
+    document = BA.encrypt_json(json_response, server_private_key, user_public_key, sections_to_encrypt=sections_to_encrypt,
+                               session=g.get('session'), mode='GCM', merkle_section=merkle_section)
+
+    if request.accept_mimetypes.best_match(['application/json', BA.BINARY_CONTENT_TYPE]) == BA.BINARY_CONTENT_TYPE:
+        response = app.response_class(BA.pack_document(document), mimetype=BA.BINARY_CONTENT_TYPE)
+    else:
+        response = app.json.response(document)
+    if merkle_section is not None:
+        # the catalog travels in clear next to the content, there is
+        # nothing secret to leak through its compressed size
+        compress_response(response)
+    return response, status_code
+
+def compress_response(response):
+    ''' Compresses the body with gzip if the client accepts it and it is
+        large enough to be worth it.'''
+    body = response.get_data()
+    if 'gzip' not in request.accept_encodings or len(body) < BA.COMPRESS_THRESHOLD:
+        return
+    response.set_data(gzip.compress(body))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+
+@app.before_request
+def start_phase_stats():
+    if INSTRUMENT:
+        g.phase_stats = BA.PhaseStats().start()
+
+@app.after_request
+def report_phase_stats(response):
+    stats = g.get('phase_stats')
+    if stats is not None:
+        stats.stop()
+        print(f"{request.path} {response.status_code}\n{stats.report()}", file=sys.stderr)
+    return response
 
 
 # ----- RESTAURANTS -----
 
 @app.post("/api/restaurants")
 def api_restaurant():
-    message, user_name = read_json_request( request.get_json() )
+    message, user_name = read_json_request( get_json_request() )
 
     if message is None:
         return send_json_response({"error": user_name}, 400)
@@ -157,6 +258,9 @@ def api_restaurant():
         with database, database.cursor() as db:
             db.execute("INSERT INTO ba_restaurants (data) VALUES (%s) RETURNING id;", (json.dumps(message['data']),))
             restaurant_id = db.fetchone()[0]
+            # signed once here, list only signs the Merkle root
+            db.execute("UPDATE ba_restaurants SET fragment = (%s) WHERE id = (%s);",
+                       (json.dumps(sign_restaurant(restaurant_id, message['data'])), restaurant_id))
 
         return send_json_response({"id": restaurant_id}, 201)
 
@@ -164,11 +268,19 @@ def api_restaurant():
 
     if message['operation'] == 'list':
         with database, database.cursor() as db:
-            db.execute("SELECT id, data FROM ba_restaurants;")
+            db.execute("SELECT id, data, fragment FROM ba_restaurants ORDER BY id;")
             restaurants = db.fetchall()
 
-        return send_json_response({"restaurants": [{"id": id, "data": data}
-                                                   for id, data in restaurants]}, 200)
+            fragments = []
+            for id, data, fragment in restaurants:
+                if fragment is None:
+                    # restaurant from before fragments were stored
+                    fragment = sign_restaurant(id, data)
+                    db.execute("UPDATE ba_restaurants SET fragment = (%s) WHERE id = (%s);",
+                               (json.dumps(fragment), id))
+                fragments.append(fragment)
+
+        return send_json_response({"restaurants": fragments}, 200, merkle_section='restaurants')
 
     # ----- READ -----
     
@@ -212,8 +324,12 @@ def api_restaurant():
             return send_json_response({"error": "Missing id or data"}, 400)
 
         with database, database.cursor() as db:
-            db.execute("UPDATE ba_restaurants SET data = (%s) WHERE id = (%s);",
+            db.execute("UPDATE ba_restaurants SET data = (%s) WHERE id = (%s) RETURNING id;",
                        (json.dumps(message['data']), message['id']))
+            result = db.fetchone()
+            if result is not None:
+                db.execute("UPDATE ba_restaurants SET fragment = (%s) WHERE id = (%s);",
+                           (json.dumps(sign_restaurant(result[0], message['data'])), result[0]))
 
         return send_json_response({}, 200)
 
@@ -238,7 +354,7 @@ def api_restaurant():
 
 @app.post("/api/users")
 def api_users():
-    message, user_name = read_json_request( request.get_json() )
+    message, user_name = read_json_request( get_json_request() )
 
     if message is None:
         return send_json_response({"error": user_name}, 400)
@@ -297,7 +413,10 @@ def api_users():
         if result[0] != message['public_key']:
             return send_json_response({"error": "Invalid public key"}, 403)
 
-        return send_json_response({}, 200)
+        # hand out a session key, wrapped with the user's public key
+        session = session_store.start(user_name)
+
+        return send_json_response(session.export(), 200, user_name, sections_to_encrypt=['session_key'])
 
     # ----- UPDATE -----
 
@@ -325,6 +444,7 @@ def api_users():
             return send_json_response({"error": "Cannot delete other users as a user"}, 403)
     
         cached_users.pop(message['user_name_to_delete'], None)
+        session_store.purge(message['user_name_to_delete'])
 
         with database, database.cursor() as db:
             db.execute("DELETE FROM ba_vouchers WHERE user_name = (%s);", (message['user_name_to_delete'],))
@@ -338,7 +458,7 @@ def api_users():
 
 @app.post("/api/vouchers")
 def api_vouchers():
-    message, user_name = read_json_request( request.get_json() )
+    message, user_name = read_json_request( get_json_request() )
 
     if message is None:
         return send_json_response({"error": user_name}, 400)
@@ -400,7 +520,7 @@ def api_vouchers():
 
 @app.post("/api/reviews")
 def api_reviews():
-    message, user_name = read_json_request( request.get_json() )
+    message, user_name = read_json_request( get_json_request() )
 
     if message is None:
         return send_json_response({"error": user_name}, 400)
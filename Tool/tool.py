@@ -1,129 +1,501 @@
+import os
 import sys
+import glob
 import json
+import time
+import queue
+import platform
+import atexit
 import argparse
+import threading
+import collections
+from concurrent.futures import ProcessPoolExecutor
 
 sys.path.append('..')
 try:
     import BombAppetit as BA
+    from BombAppetit import benchmark
 except ImportError:
     print("Import failed. Install dependencies with: pip3 install -r requirements.txt")
     sys.exit(1)
 
 parser = argparse.ArgumentParser(description='BombAppetit library front-end demo.')
-parser.add_argument('action', choices=['generate', 'protect', 'unprotect', 'check'], help='Action to perform')
+parser.add_argument('action', choices=['generate', 'protect', 'unprotect', 'check', 'bench'], help='Action to perform')
 
 # generate has one argument: outfile
+#    with --count N, keypair i is saved as private_/public_<name>_<i><ext>
+#    on --jobs processes, and manifest_<name>.json lists the files and the
+#    fingerprint of every keypair
+# bench has one optional argument: outfile, where results are saved as JSON
 # protect has five arguments: infile, src_key, dst_key, outfile, sections_to_encrypt
 #    dst_key is optional, if not provided it means no encryption
 #    sections_to_encrypt is a comma-separated list of sections to encrypt
 # unprotect has four arguments: infile, src_key, dst_key, outfile
 #    dst_key is optional if infile is not encrypted
-# check has three arguments: infile, src_key, dst_key
-#    dst_key is optional if infile is not encrypted
+# check has two arguments: infile, src_key
+#    only the signature, timestamp and nonce are checked, nothing is
+#    decrypted so no dst_key is needed
+#
+# protect, unprotect and check also take many files at once: infile may be a
+# directory, a glob pattern (quoted) or @manifest, a file listing one path per
+# line. outfile is then a directory, created if needed, where each file keeps
+# its path below the directory common to all inputs. Keys are loaded once
+# and files are processed on --jobs processes.
+#
+# With --stream, protect, unprotect and check read newline-delimited JSON
+# documents from stdin and write one result per line to stdout, give - as
+# infile and outfile. check passes valid documents through. Failed lines are
+# reported on stderr. Without --jobs every result is written as soon as its
+# line is read. With --jobs lines are sent to the workers in chunks, a chunk
+# goes as soon as it is full or input pauses, and results are written in
+# order as they complete.
 
-parser.add_argument('infile', help='Input file')
+parser.add_argument('infile', nargs='?', help='Input file')
 parser.add_argument('src_key', nargs='?', help='Source key file')
 parser.add_argument('dst_key', nargs='?', help='Destination key file')
 parser.add_argument('outfile', nargs='?', help='Output file')
 parser.add_argument('sections_to_encrypt', nargs='?', help='Sections to encrypt')
+parser.add_argument('--suite', choices=['rsa', 'ed25519'], default='rsa', help='Cipher suite of generated keys')
+parser.add_argument('--mode', choices=['CBC', 'GCM'], default='CBC', help='AES mode used by protect')
+parser.add_argument('--compress', choices=BA.COMPRESSION_ALGORITHMS, default=None, help='Compress large sections before protect encrypts them')
+parser.add_argument('--profile', action='store_true', help='Print time spent per crypto phase to stderr')
+parser.add_argument('--nonce-store', default='seen_nonces.sqlite', help='SQLite file of the nonces seen by unprotect')
+parser.add_argument('--jobs', type=int, default=None, help='Worker processes, default one per CPU for many files, none for --stream')
+parser.add_argument('--stream', action='store_true', help='Read NDJSON documents from stdin, write results to stdout')
+parser.add_argument('--sizes', default='1,10,100', help='bench: comma-separated restaurants per document')
+parser.add_argument('--iterations', type=int, default=50, help='bench: timed iterations per phase and size')
+parser.add_argument('--size', type=int, default=None, help='RSA key size, default 4096 for generate, 2048 for bench')
+parser.add_argument('--count', type=int, default=1, help='generate: number of keypairs')
+
+# Worker processes may be spawned rather than forked, they import this file
+# without running main(). Functions run by workers get the keys, as PEM, and
+# the options they need as arguments, never through args or other globals.
+
+args = None # parsed by main()
+
+def generate_keypair(outfile, suite='rsa', size=None):
+    ''' Generates a keypair, stores it in 'private_' and 'public_' prefixed
+        output files and returns its fingerprint.'''
+    if suite == 'ed25519':
+        private_key, public_key = BA.create_ed25519_keypair()
+    else:
+        private_key, public_key = BA.create_keypair(size or 4096)
+
+    directory, name = os.path.split(outfile)
+    BA.save_key(os.path.join(directory, 'private_' + name), private_key)
+    BA.save_key(os.path.join(directory, 'public_' + name), public_key)
+    return BA.key_fingerprint(public_key)
+
+BENCH_PHASES = ('protect', 'unprotect', 'check')
+
+def bench_document(restaurants):
+    ''' Returns a synthetic document of restaurants shaped like
+        Client/restaurantInfo/*.json, a single one or a list.'''
+    if restaurants == 1:
+        return benchmark.synthetic_restaurant(0)
+    return { 'restaurants': [{ 'id': index, 'data': benchmark.synthetic_restaurant(index) }
+                             for index in range(restaurants)],
+             'mealVouchers': [] }
+
+def bench_worker(restaurants, iterations, private_pem, public_pem, mode):
+    ''' Times every phase iterations times with the keypair given as PEM.
+        Returns {phase: samples}.'''
+    private_key = BA.str_to_key(private_pem)
+    public_key  = BA.str_to_key(public_pem)
+    document  = bench_document(restaurants)
+    protected = BA.encrypt_json(document, private_key, public_key, ['mealVouchers'], mode=mode)
+    run = { 'protect':   lambda: BA.encrypt_json(document, private_key, public_key, ['mealVouchers'], mode=mode),
+            'unprotect': lambda: BA.decrypt_json(protected, public_key, private_key, freshness_check=False),
+            'check':     lambda: BA.check_json(protected, public_key, freshness_check=False), }
+    return { phase: benchmark.time_operation(run[phase], iterations, 1) for phase in BENCH_PHASES }
+
+def run_bench(private_key, public_key):
+    ''' Runs every phase over every document size, prints a table and
+        returns the results as a JSON object.'''
+    jobs = args.jobs or 1
+    keys = (private_key.export_key(format='PEM'), public_key.export_key(format='PEM'), args.mode)
+    results = {}
+    for restaurants in [int(size) for size in args.sizes.split(',')]:
+        size = len(json.dumps(bench_document(restaurants)))
+        per_worker = max(1, args.iterations // jobs)
+
+        start = time.perf_counter()
+        if jobs == 1:
+            samples = [bench_worker(restaurants, per_worker, *keys)]
+        else:
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                samples = list(pool.map(bench_worker, [restaurants] * jobs, [per_worker] * jobs,
+                                        *[[key] * jobs for key in keys]))
+        elapsed = time.perf_counter() - start
+
+        case = f'restaurants_{restaurants}'
+        results[case] = { 'payload_bytes': size }
+        for phase in BENCH_PHASES:
+            phase_samples = [sample for worker in samples for sample in worker[phase]]
+            summary = benchmark.summarize(phase_samples)
+            # throughput over all workers, latency per operation
+            busy = max(sum(worker[phase]) for worker in samples)
+            summary['ops_per_sec'] = len(phase_samples) / busy if busy else 0.0
+            summary['mb_per_sec']  = summary['ops_per_sec'] * size / 1e6
+            results[case][phase] = summary
+            print(f"{case:18} {phase:10} {summary['ops_per_sec']:10.1f} ops/s {summary['mb_per_sec']:9.2f} MB/s"
+                  f"  p50 {summary['p50_ms']:8.3f} ms  p99 {summary['p99_ms']:8.3f} ms")
+        results[case]['wall_seconds'] = elapsed
+
+    return { 'meta': { 'suite': args.suite, 'key_size': args.size or 2048, 'mode': args.mode,
+                       'jobs': jobs, 'iterations': args.iterations,
+                       'cpus': os.cpu_count(), 'machine': platform.machine(), 'python': platform.python_version(), },
+             'results': results, }
+
+def load_key(path):
+    ''' Loads a key file, None if no path is given.'''
+    if path is None:
+        return None
+    with open(path, 'rb') as f:
+        return BA.str_to_key(f.read())
+
+def is_batch(infile):
+    return os.path.isdir(infile) or glob.has_magic(infile) or infile.startswith('@')
+
+def expand_inputs(infile):
+    ''' Returns the (input path, output name) pairs of a directory, glob or
+        @manifest. Output names are relative to the directory, or to the
+        deepest directory common to all the inputs.'''
+    if infile.startswith('@'):
+        with open(infile[1:], 'r') as f:
+            paths = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    elif os.path.isdir(infile):
+        paths = sorted(os.path.join(root, name) for root, _, names in os.walk(infile)
+                       for name in names if name.endswith('.json'))
+        return [(path, os.path.relpath(path, infile)) for path in paths]
+    else:
+        paths = sorted(glob.glob(infile, recursive=True))
+    if not paths:
+        return []
+
+    root = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in paths])
+    inputs = [(path, os.path.relpath(os.path.abspath(path), root)) for path in paths]
+    # a file listed twice would be processed twice and overwrite itself
+    first = {}
+    for path, name in inputs:
+        if name in first:
+            parser.error(f"{first[name]} and {path} would both be written to {name}")
+        first[name] = path
+    return inputs
+
+def run_batch(action, sections_to_encrypt):
+    ''' Runs action over every file of args.infile, prints one status line
+        per file and a summary. Returns the number of failures.'''
+    inputs = expand_inputs(args.infile)
+    if not inputs:
+        # an empty batch is most likely a wrong path or pattern
+        parser.error(f"no input files found for {args.infile}")
+    src_key = load_key(args.src_key)
+    dst_key = load_key(args.dst_key)
+
+    documents = []
+    results = [None] * len(inputs)
+    for index, (path, _) in enumerate(inputs):
+        try:
+            with open(path, 'r') as f:
+                documents.append((index, json.load(f)))
+        except (OSError, ValueError) as e:
+            results[index] = (None, f"cannot read: {e}")
+
+    indexes = [index for index, _ in documents]
+    documents = [document for _, document in documents]
+    if action == 'protect':
+        batch_results = BA.encrypt_many(documents, src_key, dst_key, sections_to_encrypt, mode=args.mode,
+                                        max_workers=args.jobs, compress=args.compress)
+    elif action == 'unprotect':
+        batch_results = BA.decrypt_many(documents, src_key, dst_key, seen_nonces=get_nonces(), max_workers=args.jobs)
+    else:
+        batch_results = BA.check_many(documents, src_key, seen_nonces=get_nonces(), max_workers=args.jobs)
+    for index, result in zip(indexes, batch_results):
+        results[index] = result
+
+    if action != 'check':
+        os.makedirs(args.outfile, exist_ok=True)
+    failed = 0
+    for (path, name), (value, error) in zip(inputs, results):
+        if value is None or value is False:
+            failed += 1
+            print(f"FAILED {path}: {error}")
+            continue
+        if action != 'check':
+            outfile = os.path.join(args.outfile, name)
+            os.makedirs(os.path.dirname(outfile) or '.', exist_ok=True)
+            with open(outfile, 'w') as f:
+                json.dump(value, f)
+        print(f"OK     {path}")
+
+    print(f"{len(inputs)} files, {len(inputs) - failed} ok, {failed} failed")
+    return failed
+
+def get_nonces(path=None):
+    ''' Returns the store of seen nonces, in args.nonce_store by default.
+        Nonces expire with the freshness window, and concurrent runs of the
+        tool share the store safely.'''
+    return BA.SQLiteReplayStore(path or args.nonce_store)
+
+STREAM_CHUNK = 16   # lines per task sent to a worker
+STREAM_IDLE  = 0.05 # seconds without input before a partial chunk is sent
+
+# nonce store path -> store, opened once per process by stream_lines()
+stream_nonces = {}
+
+def stream_options(action, sections_to_encrypt):
+    ''' Returns what stream_lines() needs for action, keys as PEM, so it can
+        be sent to a worker process.'''
+    def pem(path):
+        if path is None:
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+    return { 'src_key': pem(args.src_key), 'dst_key': pem(args.dst_key),
+             'sections_to_encrypt': sections_to_encrypt, 'mode': args.mode, 'compress': args.compress,
+             'nonce_store': args.nonce_store if action != 'protect' else None, }
+
+def stream_lines(action, lines, options):
+    ''' Runs action over NDJSON lines with the stream_options(), returns a
+        (line out, error) pair per line.'''
+    src_key = BA.str_to_key(options['src_key']) if options['src_key'] is not None else None
+    dst_key = BA.str_to_key(options['dst_key']) if options['dst_key'] is not None else None
+    nonces = None
+    if options['nonce_store'] is not None:
+        if options['nonce_store'] not in stream_nonces:
+            stream_nonces[options['nonce_store']] = get_nonces(options['nonce_store'])
+        nonces = stream_nonces[options['nonce_store']]
 
-args = parser.parse_args()
+    results = []
+    for line in lines:
+        try:
+            document = json.loads(line)
+            if action == 'protect':
+                value = BA.encrypt_json(document, src_key, dst_key, options['sections_to_encrypt'],
+                                        mode=options['mode'], compress=options['compress'])
+            elif action == 'unprotect':
+                value, nonce = BA.decrypt_json(document, src_key, dst_key, seen_nonces=nonces)
+                if value is None:
+                    raise ValueError(nonce)
+            else:
+                # valid documents pass through unchanged
+                valid, nonce = BA.check_json(document, src_key, seen_nonces=nonces)
+                if valid is None:
+                    raise ValueError(nonce)
+                value = document
+            results.append((json.dumps(value), None))
+        except Exception as e:
+            results.append((None, f"{type(e).__name__}: {e}"))
+    return results
 
-if args.action == 'generate':
-    # generate key pair, store in 'private_' and 'public_' prefixed output files
-    private_key, public_key = BA.create_keypair(4096)
+def read_lines(stream, lines):
+    ''' Puts the non-empty lines of stream on the queue lines, then None.'''
+    for line in stream:
+        if line.strip():
+            lines.put(line)
+    lines.put(None)
 
-    BA.save_key('private_' + args.infile, private_key)
-    BA.save_key('public_' + args.infile, public_key)
-    exit(0)
+def run_stream(action, options):
+    ''' Reads NDJSON documents from stdin and writes the results to stdout,
+        in input order, as they complete. Failed lines are reported on
+        stderr. Returns the number of failures.'''
+    failed = 0
+    line_number = 0
 
-if args.action == 'protect':
-    # load json from infile
-    with open(args.infile, 'r') as f:
-        json_object = json.load(f)
+    def write(results):
+        nonlocal failed, line_number
+        for value, error in results:
+            line_number += 1
+            if value is None:
+                failed += 1
+                print(f"line {line_number}: {error}", file=sys.stderr)
+            else:
+                sys.stdout.write(value + '\n')
+        sys.stdout.flush()
 
-    # load source key
-    with open(args.src_key, 'rb') as f:
-        src_key = BA.str_to_key(f.read())
+    if args.jobs is None or args.jobs <= 1:
+        # one line at a time, each result is out before the next line is read
+        for line in sys.stdin:
+            if line.strip():
+                write(stream_lines(action, [line], options))
+        return failed
 
-    # load destination key
-    with open(args.dst_key, 'rb') as f:
-        dst_key = BA.str_to_key(f.read())
-    
+    # stdin is read on a thread, so a quiet pipe never holds results back:
+    # a partial chunk is sent after STREAM_IDLE, and finished chunks are
+    # written in order as soon as they are done
+    # workers close sys.stdin when they start, the thread reads its own
+    # copy so a worker forked while it waits does not block on its lock
+    lines = queue.Queue(maxsize=4 * STREAM_CHUNK * args.jobs)
+    stdin = os.fdopen(os.dup(sys.stdin.fileno()), 'r', encoding=sys.stdin.encoding)
+    threading.Thread(target=read_lines, args=(stdin, lines), daemon=True).start()
+
+    # at most two chunks per worker in flight, so memory stays bounded
+    pending = collections.deque()
+    chunk = []
+    end = False
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        while not end:
+            try:
+                line = lines.get(timeout=STREAM_IDLE)
+            except queue.Empty:
+                line = ''
+            if line is None:
+                end = True
+            elif line:
+                chunk.append(line)
+            if chunk and (len(chunk) == STREAM_CHUNK or not line):
+                pending.append(pool.submit(stream_lines, action, chunk, options))
+                chunk = []
+            while pending and (pending[0].done() or len(pending) >= 2 * args.jobs):
+                write(pending.popleft().result())
+        while pending:
+            write(pending.popleft().result())
+    return failed
+def main():
+    global args
+    args = parser.parse_args()
+    if args.infile is None and args.action != 'bench':
+        parser.error(f"{args.action} needs an infile")
+    if args.action == 'check' and args.src_key is None:
+        # without the signer key there is nothing to check
+        parser.error("check needs a src_key")
+    if args.action in ('protect', 'unprotect') and not args.stream and args.outfile is None:
+        parser.error(f"{args.action} needs an outfile")
+
+    if args.profile:
+        phase_stats = BA.PhaseStats().start()
+        atexit.register(lambda: print(phase_stats.report(), file=sys.stderr))
+
+    if args.action == 'generate' and args.count == 1:
+        generate_keypair(args.infile, args.suite, args.size)
+        exit(0)
+
+    if args.action == 'generate':
+        directory, name = os.path.split(args.infile)
+        stem, ext = os.path.splitext(name)
+        width = len(str(args.count))
+        outfiles = [os.path.join(directory, f'{stem}_{index:0{width}}{ext}') for index in range(1, args.count + 1)]
+        # the workers only write files, the directory must exist beforehand
+        os.makedirs(directory or '.', exist_ok=True)
+
+        if args.jobs == 1:
+            fingerprints = [generate_keypair(outfile, args.suite, args.size) for outfile in outfiles]
+        else:
+            with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+                fingerprints = list(pool.map(generate_keypair, outfiles, [args.suite] * args.count,
+                                             [args.size] * args.count))
+
+        manifest = [{ 'private_key': os.path.join(os.path.dirname(outfile), 'private_' + os.path.basename(outfile)),
+                      'public_key':  os.path.join(os.path.dirname(outfile), 'public_' + os.path.basename(outfile)),
+                      'fingerprint': fingerprint, }
+                    for outfile, fingerprint in zip(outfiles, fingerprints)]
+        with open(os.path.join(directory, f'manifest_{stem}.json'), 'w') as f:
+            json.dump({ 'suite': args.suite, 'size': (args.size or 4096) if args.suite == 'rsa' else None,
+                        'keypairs': manifest }, f, indent=2)
+        print(f"Generated {args.count} keypairs, manifest in {os.path.join(directory, f'manifest_{stem}.json')}")
+        exit(0)
+
+    if args.action == 'bench':
+        if args.suite == 'ed25519':
+            bench_private_key, bench_public_key = BA.create_ed25519_keypair()
+        else:
+            bench_private_key, bench_public_key = BA.create_keypair(args.size or 2048)
+        bench_results = run_bench(bench_private_key, bench_public_key)
+        if args.infile is not None:
+            with open(args.infile, 'w') as f:
+                json.dump(bench_results, f, indent=2)
+        exit(0)
+
+    sections_to_encrypt = None
     if args.sections_to_encrypt is not None:
         sections_to_encrypt = json.loads(args.sections_to_encrypt)
 
-    # encrypt json
-    encrypted_json = BA.encrypt_json(json_object, src_key, dst_key, sections_to_encrypt)
-
-    # write encrypted json to outfile
-    with open(args.outfile, 'w') as f:
-        json.dump(encrypted_json, f)
-    exit(0)
-
-def get_nonces():
-    try:
-        with open('seen_nonces.json', 'r') as f:
-            seen_nonces = set( json.load(f) )
-    except FileNotFoundError:
-        seen_nonces = set()
-    return seen_nonces
-
-def set_nonces(seen_nonces):
-    with open('seen_nonces.json', 'w') as f:
-        json.dump(list(seen_nonces), f)
-
-if args.action == 'unprotect':
-    # load encrypted json from infile
-    with open(args.infile, 'r') as f:
-        encrypted_json = json.load(f)
-
-    # load source key
-    with open(args.src_key, 'rb') as f:
-        src_key = BA.str_to_key(f.read())
-
-    # load destination key
-    with open(args.dst_key, 'rb') as f:
-        dst_key = BA.str_to_key(f.read())
-
-    # decrypt json
-    nonces = get_nonces()
-    json_object, nonce = BA.decrypt_json(encrypted_json, src_key, dst_key, seen_nonces=nonces)
-    if json_object is None:
-        print(f"ERROR: Document is invalid, reason: {nonce}")
-        exit(1)
-    nonces.add(nonce)
-    set_nonces(nonces)
-
-    # write decrypted json to outfile
-    with open(args.outfile, 'w') as f:
-        json.dump(json_object, f)
-    exit(0)
-
-if args.action == 'check':
-    # load encrypted json from infile
-    with open(args.infile, 'r') as f:
-        encrypted_json = json.load(f)
-
-    # load source key
-    with open(args.src_key, 'rb') as f:
-        src_key = BA.str_to_key(f.read())
-
-    # load destination key
-    with open(args.dst_key, 'rb') as f:
-        dst_key = BA.str_to_key(f.read())
-
-    # check json
-    try:
+    if args.action == 'protect' and is_batch(args.infile) and not args.stream:
+        exit(1 if run_batch('protect', sections_to_encrypt) else 0)
+
+    if args.action == 'protect' and not args.stream:
+        # load json from infile
+        with open(args.infile, 'r') as f:
+            json_object = json.load(f)
+
+        # load source key
+        with open(args.src_key, 'rb') as f:
+            src_key = BA.str_to_key(f.read())
+
+        # load destination key
+        with open(args.dst_key, 'rb') as f:
+            dst_key = BA.str_to_key(f.read())
+
+        # encrypt json
+        encrypted_json = BA.encrypt_json(json_object, src_key, dst_key, sections_to_encrypt, mode=args.mode,
+                                         compress=args.compress)
+
+        # write encrypted json to outfile
+        with open(args.outfile, 'w') as f:
+            json.dump(encrypted_json, f)
+        exit(0)
+
+    if args.stream:
+        try:
+            exit(1 if run_stream(args.action, stream_options(args.action, sections_to_encrypt)) else 0)
+        except BrokenPipeError:
+            # the reader went away, e.g. | head, stop without a traceback
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+            exit(1)
+
+    if args.action in ('unprotect', 'check') and is_batch(args.infile):
+        exit(1 if run_batch(args.action, None) else 0)
+
+    if args.action == 'unprotect':
+        # load encrypted json from infile
+        with open(args.infile, 'r') as f:
+            encrypted_json = json.load(f)
+
+        # load source key
+        with open(args.src_key, 'rb') as f:
+            src_key = BA.str_to_key(f.read())
+
+        # load destination key
+        with open(args.dst_key, 'rb') as f:
+            dst_key = BA.str_to_key(f.read())
+
+        # decrypt json
+        # the nonce is recorded by decrypt_json
         nonces = get_nonces()
-        j, n = BA.check_json(encrypted_json, src_key, dst_key, seen_nonces=nonces)
-        if j is None:
-            print(f"ERROR: Document is invalid, reason: {n}")
+        json_object, nonce = BA.decrypt_json(encrypted_json, src_key, dst_key, seen_nonces=nonces)
+        if json_object is None:
+            print(f"ERROR: Document is invalid, reason: {nonce}")
+            exit(1)
+
+        # write decrypted json to outfile
+        with open(args.outfile, 'w') as f:
+            json.dump(json_object, f)
+        exit(0)
+
+    if args.action == 'check':
+        # load encrypted json from infile
+        with open(args.infile, 'r') as f:
+            encrypted_json = json.load(f)
+
+        # load source key
+        with open(args.src_key, 'rb') as f:
+            src_key = BA.str_to_key(f.read())
+
+        # check json, signature, timestamp and nonce only
+        try:
+            nonces = get_nonces()
+            valid, nonce = BA.check_json(encrypted_json, src_key, seen_nonces=nonces)
+            if valid is None:
+                print(f"ERROR: Document is invalid, reason: {nonce}")
+                exit(1)
+
+        except Exception as e:
+            print(f"ERROR: Document is invalid, reason: {e}")
             exit(1)
 
-    except Exception as e:
-        print(f"ERROR: Document is invalid, reason: {e}")
-        exit(1)
+        print(f"Document is valid, nonce: {nonce}")
+        exit(0)
 
-    print(f"Document is valid, nonce: {nonce}")
-    exit(0)
+if __name__ == '__main__':
+    main()